@@ -17,20 +17,29 @@
 Model definitions for an SQLAlchemy ORM
 """
 
+from cStringIO import StringIO
 from datetime import datetime
+from itertools import islice
 
+import numpy as np
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, DDL
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import column_property
 from sqlalchemy.orm.exc import NoResultFound
 
 from geoalchemy import GeometryColumn, LineString, GeometryDDL, \
                        WKTSpatialElement
+from geoalchemy.base import SpatialComparator
+from geoalchemy.geometry import GeometryExtensionColumn, SpatialAttribute
 from geoalchemy.functions import BaseFunction
 from geoalchemy.dialect import SpatialDialect
 from geoalchemy.postgis import pg_functions
 
-from webapp import app
-from rk import RK
+from webapp import app, SPHEROID
+from rk import RK, parse_time
 from util import monkeypatch, monkeypatchclass
+from wkb import encode_linestring, decode_linestring
 
 
 # Flask-SQLAlchemy object
@@ -60,6 +69,17 @@ def get_function(self, function_cls):
         return self.__super__get_function(function_cls)
 
 
+def DeferredGeometryColumn(*args, **kwargs):
+    """
+    A GeometryColumn that is only loaded when it is accessed
+    """
+
+    return column_property(GeometryExtensionColumn(*args, **kwargs),
+                           extension=SpatialAttribute(),
+                           comparator_factory=SpatialComparator,
+                           deferred=True)
+
+
 class User(db.Model):
     """
     Represents a user we've connected with.
@@ -75,6 +95,8 @@ class User(db.Model):
                         default=datetime.utcnow, onupdate=datetime.utcnow)
     service = db.Column(db.String(128), default='RunKeeper', nullable=False)
     token = db.Column(db.String(128))
+    # the start time of the newest activity synced, see sync.Sync
+    sync_watermark = db.Column(db.DateTime)
 
     tracks = db.relationship('Track', cascade="all, delete, delete-orphan")
 
@@ -130,10 +152,40 @@ class Track(db.Model):
     date = db.Column(db.DateTime, nullable=False)
     updated = db.Column(db.DateTime, nullable=False,
                      default=datetime.utcnow, onupdate=datetime.utcnow)
-    points = GeometryColumn(LineString(4), nullable=False)
+    # spatial_index creates a GiST index on points
+    points = GeometryColumn(LineString(4, spatial_index=True), nullable=False)
+
+    # simplified copies of points for drawing and scanning at lower
+    # resolutions, filled in by the tracks_summarise trigger. They are
+    # deferred so that loading a Track doesn't fetch them.
+    points_medium = DeferredGeometryColumn(
+        LineString(4, spatial_index=False))
+    points_low = DeferredGeometryColumn(LineString(4, spatial_index=False))
+
+    # (ST_Simplify tolerance in degrees, column), coarsest first
+    SIMPLIFIED = (
+        (0.001, 'points_low'), # ~100m
+        (0.0001, 'points_medium'), # ~10m
+    )
+
+    # filled in from points by the tracks_summarise trigger
+    length = db.Column(db.Float) # metres
+    minlon = db.Column(db.Float)
+    minlat = db.Column(db.Float)
+    maxlon = db.Column(db.Float)
+    maxlat = db.Column(db.Float)
 
     user = db.relationship('User')
 
+    __table_args__ = (
+        # named, so that upserts can refer to it whether or not the table
+        # is partitioned, see partition()
+        db.UniqueConstraint('user_pk', 'track_id',
+                            name='tracks_user_pk_track_id_key'),
+        db.Index('ix_tracks_user_pk_date', 'user_pk', 'date'),
+        db.Index('ix_tracks_date', 'date'),
+    )
+
     def __init__(self, *args, **kwargs):
         """
         Turn user_id into a User model
@@ -182,6 +234,344 @@ class Track(db.Model):
 
         return obj
 
+    @classmethod
+    def bulk_from_rk_json(cls, jsons, batch_size=500):
+        """
+        CREATE or UPDATE many Tracks from RK JSON format
+
+        Tracks are loaded @batch_size at a time: new tracks with a single
+        COPY, existing tracks with a single executemany UPDATE, and the batch
+        is committed once. Geometries are sent as EWKB.
+
+        Returns the number of tracks written, counting each track once even
+        if it appears more than once in a batch.
+        """
+
+        jsons = iter(jsons)
+        ntracks = 0
+
+        while True:
+            batch = list(islice(jsons, batch_size))
+
+            if not batch:
+                break
+
+            ntracks += cls._bulk_load(batch)
+            db.session.commit()
+
+        return ntracks
+
+    @classmethod
+    def _bulk_load(cls, batch):
+        # look up all of the users in the batch at once
+        user_ids = set(json['userID'] for json in batch)
+        users = dict(db.session.query(User.user_id, User.id).filter(
+            User.user_id.in_(user_ids)))
+
+        missing = user_ids - set(users)
+        if missing:
+            raise NoResultFound("No users {}".format(sorted(missing)))
+
+        # and all of the tracks in the batch we already have
+        existing = dict(((user_pk, track_id), (pk, date))
+            for pk, user_pk, track_id, date in db.session.query(
+                Track.id, Track.user_pk, Track.track_id, Track.date).filter(
+                Track.user_pk.in_(users.values()),
+                Track.track_id.in_(set(json['uri'] for json in batch))))
+
+        now = datetime.utcnow()
+
+        # later copies of the same track replace earlier ones
+        rows = {}
+
+        for json in batch:
+            track_id, activity_date, points = _rk_json_row(json)
+
+            rows[(users[json['userID']], track_id)] = (activity_date, points)
+
+        copy = StringIO()
+        updates = []
+        moved = []
+
+        for (user_pk, track_id), (activity_date, points) in rows.iteritems():
+            pk, date = existing.get((user_pk, track_id), (None, None))
+
+            if date == activity_date:
+                updates.append((points, now, pk))
+                continue
+            elif pk is not None:
+                # the date is part of the key of a partitioned table, so
+                # tracks whose date has changed are moved, see
+                # upsert_rk_json()
+                moved.append((pk, date))
+
+            copy.write('\t'.join((str(user_pk),
+                                  _copy_escape(track_id),
+                                  activity_date.isoformat(),
+                                  now.isoformat(),
+                                  points)) + '\n')
+
+        cursor = db.session.connection().connection.cursor()
+
+        if moved:
+            cursor.executemany('DELETE FROM tracks '
+                               'WHERE id = %s AND date = %s', moved)
+
+        copy.seek(0)
+        cursor.copy_expert('COPY tracks (user_pk, track_id, date, updated, '
+                           'points) FROM STDIN', copy)
+
+        if updates:
+            cursor.executemany('UPDATE tracks '
+                               'SET points = %s::geometry, updated = %s '
+                               'WHERE id = %s', updates)
+
+        return len(rows)
+
+    @classmethod
+    def upsert_rk_json(cls, user, jsons, commit=True):
+        """
+        CREATE or UPDATE many of @user's Tracks from RK JSON format
+
+        The user is resolved once, and every track sent in a single
+        INSERT ... ON CONFLICT on (user_pk, track_id) (and date, if the
+        table is partitioned). Tracks whose date has changed are deleted
+        first and inserted again, so both layouts move them.
+
+        Returns the number of tracks written.
+        """
+
+        user_pk = _user_pk(user)
+        now = datetime.utcnow()
+
+        # later copies of the same track replace earlier ones
+        rows = {}
+
+        for json in jsons:
+            track_id, activity_date, points = _rk_json_row(json)
+            rows[track_id] = (user_pk, track_id, activity_date, now, points)
+
+        if rows:
+            cursor = db.session.connection().connection.cursor()
+
+            dates = ','.join(
+                cursor.mogrify('(%s, %s, %s::timestamp)', row[:3])
+                for row in rows.itervalues())
+
+            cursor.execute(
+                'DELETE FROM tracks USING (VALUES ' + dates + ') '
+                'AS new (user_pk, track_id, date) '
+                'WHERE tracks.user_pk = new.user_pk '
+                'AND tracks.track_id = new.track_id '
+                'AND tracks.date <> new.date')
+
+            values = ','.join(
+                cursor.mogrify('(%s, %s, %s, %s, %s::geometry)', row)
+                for row in rows.itervalues())
+
+            cursor.execute(
+                'INSERT INTO tracks (user_pk, track_id, date, updated, points) '
+                'VALUES ' + values + ' '
+                'ON CONFLICT ON CONSTRAINT tracks_user_pk_track_id_key '
+                'DO UPDATE '
+                'SET points = EXCLUDED.points, updated = EXCLUDED.updated')
+
+        if commit:
+            db.session.commit()
+
+        return len(rows)
+
+    @classmethod
+    def get_updated(cls, user, track_ids):
+        """
+        Returns a dict of track_id to updated time for those of @track_ids
+        that @user already has, in a single query.
+        """
+
+        track_ids = set(track_ids)
+
+        if not track_ids:
+            return {}
+
+        return dict(db.session.query(Track.track_id, Track.updated).filter(
+            Track.user_pk == _user_pk(user),
+            Track.track_id.in_(track_ids)))
+
+    @classmethod
+    def query_tracks(cls, bbox=None, start=None, end=None, user=None,
+                     batch_size=100):
+        """
+        Returns a query for the tracks intersecting @bbox (minlon, minlat,
+        maxlon, maxlat) and dated within [@start, @end), optionally only for
+        @user. Any of these may be None.
+
+        Results are streamed from a server-side cursor @batch_size tracks
+        at a time.
+        """
+
+        query = db.session.query(cls)
+
+        if bbox is not None:
+            minlon, minlat, maxlon, maxlat = bbox
+            srid = cls.points.property.columns[0].type.srid
+
+            # ST_Intersects uses the GiST index on points
+            query = query.filter(func.ST_Intersects(
+                cls.points,
+                func.ST_MakeEnvelope(minlon, minlat, maxlon, maxlat, srid)))
+
+        if start is not None:
+            query = query.filter(cls.date >= start)
+
+        if end is not None:
+            query = query.filter(cls.date < end)
+
+        if user is not None:
+            query = query.filter(cls.user_pk == _user_pk(user))
+
+        return query.order_by(cls.date) \
+                    .execution_options(stream_results=True) \
+                    .yield_per(batch_size)
+
+    @classmethod
+    def points_at(cls, resolution=None):
+        """
+        Returns the coarsest geometry column that is still accurate to
+        @resolution (in degrees), or the full resolution points if
+        @resolution is None.
+        """
+
+        if resolution is not None:
+            for tolerance, column in cls.SIMPLIFIED:
+                if tolerance <= resolution:
+                    return getattr(cls, column)
+
+        return cls.points
+
+    @classmethod
+    def load_tracks(cls, query=None, resolution=None):
+        """
+        Load the points of many tracks into a processing.track.Tracks, in
+        the order of @query (by default every track, see query_tracks).
+
+        Pass @resolution (in degrees) to load simplified tracks, see
+        points_at().
+
+        The geometries are fetched as WKB and decoded with np.frombuffer,
+        the only copy made is into the Tracks columns.
+        """
+
+        # only the processing code needs lxml, pyproj, etc.
+        from processing.track import Track as TrackArray, Tracks
+
+        if query is None:
+            query = cls.query_tracks()
+
+        # .RAW, since GeoAlchemy already wraps selected geometries in
+        # ST_AsBinary
+        points = cls.points_at(resolution).RAW
+        rows = query.with_entities(cls.date, func.ST_AsBinary(points))
+
+        dates = []
+        paths = []
+
+        for date, wkb in rows:
+            dates.append(date)
+            paths.append(decode_linestring(wkb))
+
+        lens = [len(path) for path in paths]
+        offsets = np.r_[0, np.cumsum(lens, dtype=int)]
+        tracks = np.empty(offsets[-1], dtype=TrackArray.DTYPE)
+
+        for i, (date, path) in enumerate(zip(dates, paths)):
+            track = tracks[offsets[i]:offsets[i + 1]]
+
+            # x, y, z, m = lon, lat, altitude, seconds since the start
+            track['lon'] = path[:, 0]
+            track['lat'] = path[:, 1]
+            track['elev'] = path[:, 2]
+            track['time'] = np.datetime64(date, 'ms') + \
+                np.round(path[:, 3] * 1000).astype('timedelta64[ms]')
+
+        return Tracks.from_arrays(tracks, offsets)
+
+    @classmethod
+    def aggregate_grid(cls, query=None, xnum=100, ynum=100, refpoint=None,
+                       utm_zone=55):
+        """
+        Calculate a processing.binning.Grid of the tracks of @query (by
+        default every track, see query_tracks) in the database.
+
+        Only the aggregated cells are fetched, rather than every point.
+        """
+
+        from processing.binning import Grid, Direction, MELBOURNE
+
+        if refpoint is None:
+            refpoint = MELBOURNE
+
+        if query is None:
+            query = cls.query_tracks()
+
+        query = query.order_by(None)
+
+        # the bounds come from the trigger maintained track summaries
+        bounds = query.with_entities(func.min(cls.minlat),
+                                     func.max(cls.maxlat),
+                                     func.min(cls.minlon),
+                                     func.max(cls.maxlon)).one()
+
+        # select the tracks in the database, rather than sending their ids
+        ids = query.with_entities(cls.id).statement.compile(
+            dialect=postgresql.dialect(paramstyle='named'))
+
+        # bin edges, see Grid
+        minlat, maxlat, minlon, maxlon = bounds
+        xedges = np.linspace(minlon, maxlon, num=xnum)
+        yedges = np.linspace(minlat, maxlat, num=ynum)
+
+        # the same projection as pyproj's, i.e. without a false northing
+        params = dict(ids.params)
+        params.update({
+            'utm_srid': 32600 + utm_zone,
+            'reflat': refpoint.lat,
+            'reflon': refpoint.lon,
+            'inbound': Direction.INBOUND,
+            'outbound': Direction.OUTBOUND,
+            'xedges': xedges.tolist(),
+            'yedges': yedges.tolist(),
+        })
+        cells = db.session.execute(GRID_AGGREGATE.format(ids=ids), params)
+        cells = [tuple(cell) for cell in cells]
+
+        return Grid.from_cells(bounds, cells, xnum=xnum, ynum=ynum,
+                               refpoint=refpoint)
+
+    @classmethod
+    def partition(cls, interval=None):
+        """
+        Migrate the tracks table to one range partitioned on date, with a
+        partition per @interval (one of PARTITION_INTERVALS, by default
+        app.config['TRACKS_PARTITION']) covering the existing tracks.
+
+        Requires PostgreSQL 13 or later. Tracks outside of the partitions
+        go into a default partition, so create partitions ahead of time with
+        create_partitions().
+        """
+
+        _partition_tracks(db.session.connection(), interval)
+        db.session.commit()
+
+    @classmethod
+    def create_partitions(cls, start, end, interval=None):
+        """
+        Create any missing partitions covering @start to @end, see
+        partition().
+        """
+
+        _create_partitions(db.session.connection(), start, end, interval)
+        db.session.commit()
+
     @classmethod
     def get_track(self, user, track_id):
         if isinstance(user, User):
@@ -193,4 +583,411 @@ class Track(db.Model):
             User.user_id == user_id,
             Track.track_id == track_id).one()
 
+def _user_pk(user):
+    """
+    The primary key of a User, or of the user with RunKeeper user_id @user
+    """
+
+    if isinstance(user, User):
+        return user.id
+
+    return db.session.query(User.id).filter(User.user_id == user).one()[0]
+
+
+def _rk_json_row(json):
+    """
+    Returns (track_id, date, hex EWKB points) from RK JSON format
+    """
+
+    # FIXME: timezone? does RK care?
+    activity_date = parse_time(json['start_time'])
+
+    return json['uri'], activity_date, rk_json_ewkb(json).encode('hex')
+
+
+def rk_json_ewkb(json, srid=4326):
+    """
+    Returns the path of an RK JSON activity as a 4D EWKB LineString
+    """
+
+    coords = np.array([(p['longitude'], p['latitude'],
+                        p['altitude'], p['timestamp'])
+                       for p in json['path']], dtype=float)
+
+    return encode_linestring(coords, srid=srid)
+
+
+def _partition_interval(interval):
+    if interval is None:
+        interval = app.config.get('TRACKS_PARTITION')
+
+    if interval not in PARTITION_INTERVALS:
+        raise ValueError("Unknown partition interval {!r}".format(interval))
+
+    return interval
+
+
+def partition_ranges(start, end, interval):
+    """
+    Yields (name, lower, upper) for each @interval partition of tracks
+    covering @start to @end
+    """
+
+    if interval == 'year':
+        lower = datetime(start.year, 1, 1)
+    else:
+        lower = datetime(start.year, start.month, 1)
+
+    while lower <= end:
+        if interval == 'year':
+            upper = datetime(lower.year + 1, 1, 1)
+            name = 'tracks_y{:%Y}'.format(lower)
+        else:
+            upper = datetime(lower.year + lower.month // 12,
+                             lower.month % 12 + 1, 1)
+            name = 'tracks_m{:%Y_%m}'.format(lower)
+
+        yield name, lower, upper
+
+        lower = upper
+
+
+def _create_partitions(connection, start, end, interval):
+    interval = _partition_interval(interval)
+
+    for name, lower, upper in partition_ranges(start, end, interval):
+        if connection.execute('SELECT to_regclass(%s)', name).scalar():
+            continue
+
+        # PostgreSQL won't create a partition while the default partition
+        # has rows in its range, so they are moved across
+        if connection.execute(
+                'SELECT EXISTS (SELECT 1 FROM tracks_default '
+                'WHERE date >= %s AND date < %s)', lower, upper).scalar():
+            connection.execute(PARTITION_TRACKS_SPLIT_DEFAULT.format(name),
+                               {'lower': lower, 'upper': upper})
+        else:
+            connection.execute(
+                'CREATE TABLE {} PARTITION OF tracks '
+                'FOR VALUES FROM (%s) TO (%s)'.format(name), lower, upper)
+
+
+def _partition_tracks(connection, interval, recalculate=True):
+    interval = _partition_interval(interval)
+
+    connection.execute(PARTITION_TRACKS_CREATE)
+
+    start, end = connection.execute(
+        'SELECT min(date), max(date) FROM tracks_unpartitioned').first()
+
+    if start is not None:
+        _create_partitions(connection, start, end, interval)
+
+    connection.execute(PARTITION_TRACKS_MOVE)
+    connection.execute(TRACK_TRIGGERS)
+
+    if recalculate:
+        connection.execute(RECALCULATE_SITE_STATS)
+
+
+def _copy_escape(value):
+    """
+    Escape a string for COPY text format
+    """
+
+    return value.replace('\\', '\\\\') \
+                .replace('\t', '\\t') \
+                .replace('\n', '\\n')
+
+
+class SiteStats(db.Model):
+    """
+    Site-wide totals, kept up to date by triggers on the tracks table.
+    """
+
+    __tablename__ = 'site_stats'
+
+    id = db.Column(db.Integer, primary_key=True)
+    ncontributors = db.Column(db.Integer, nullable=False, default=0)
+    length = db.Column(db.Float, nullable=False, default=0.) # metres
+
+    @classmethod
+    def get(cls):
+        return db.session.query(cls).get(1)
+
+    @classmethod
+    def recalculate(cls, commit=True):
+        """
+        Recalculate the totals from scratch, e.g. after a migration.
+
+        This scans every track.
+        """
+
+        db.session.execute(RECALCULATE_SITE_STATS)
+
+        if commit:
+            db.session.commit()
+
+
 GeometryDDL(Track.__table__)
+
+
+# Keep the per-track summaries and site totals up to date in the database,
+# so that every way of writing tracks (the ORM, COPY, ON CONFLICT) and
+# cascading deletes are covered.
+TRACK_TRIGGERS = DDL("""
+CREATE OR REPLACE FUNCTION tracks_summarise() RETURNS trigger AS $$
+BEGIN
+    NEW.length := ST_LengthSpheroid(NEW.points, '{spheroid}');
+    NEW.minlon := ST_XMin(NEW.points);
+    NEW.minlat := ST_YMin(NEW.points);
+    NEW.maxlon := ST_XMax(NEW.points);
+    NEW.maxlat := ST_YMax(NEW.points);
+{simplify}
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tracks_summarise
+    BEFORE INSERT OR UPDATE OF points ON tracks
+    FOR EACH ROW EXECUTE PROCEDURE tracks_summarise();
+
+CREATE OR REPLACE FUNCTION tracks_site_stats() RETURNS trigger AS $$
+DECLARE
+    dlength double precision := 0;
+    dcontributors integer := 0;
+BEGIN
+    -- this runs once per statement, after all of its rows are written, so
+    -- a user's tracks are counted together however they were loaded
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT dlength - coalesce(sum(length), 0) INTO dlength
+        FROM old_tracks;
+
+        -- users left without any tracks
+        SELECT dcontributors - count(DISTINCT user_pk) INTO dcontributors
+        FROM old_tracks o
+        WHERE NOT EXISTS (SELECT 1 FROM tracks t
+                          WHERE t.user_pk = o.user_pk);
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'INSERT') THEN
+        SELECT dlength + coalesce(sum(length), 0) INTO dlength
+        FROM new_tracks;
+    END IF;
+
+    -- users who had no tracks before this statement
+    IF TG_OP = 'INSERT' THEN
+        SELECT dcontributors + count(DISTINCT user_pk) INTO dcontributors
+        FROM new_tracks n
+        WHERE NOT EXISTS (SELECT 1 FROM tracks t
+                          WHERE t.user_pk = n.user_pk
+                          AND t.id NOT IN (SELECT id FROM new_tracks));
+    ELSIF TG_OP = 'UPDATE' THEN
+        SELECT dcontributors + count(DISTINCT user_pk) INTO dcontributors
+        FROM new_tracks n
+        WHERE NOT EXISTS (SELECT 1 FROM tracks t
+                          WHERE t.user_pk = n.user_pk
+                          AND t.id NOT IN (SELECT id FROM new_tracks))
+        AND NOT EXISTS (SELECT 1 FROM old_tracks o
+                        WHERE o.user_pk = n.user_pk);
+    END IF;
+
+    IF dlength <> 0 OR dcontributors <> 0 THEN
+        UPDATE site_stats SET
+            length = length + dlength,
+            ncontributors = ncontributors + dcontributors;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- transition tables need a trigger per event
+CREATE TRIGGER tracks_site_stats_insert
+    AFTER INSERT ON tracks
+    REFERENCING NEW TABLE AS new_tracks
+    FOR EACH STATEMENT EXECUTE PROCEDURE tracks_site_stats();
+
+CREATE TRIGGER tracks_site_stats_update
+    AFTER UPDATE ON tracks
+    REFERENCING OLD TABLE AS old_tracks NEW TABLE AS new_tracks
+    FOR EACH STATEMENT EXECUTE PROCEDURE tracks_site_stats();
+
+CREATE TRIGGER tracks_site_stats_delete
+    AFTER DELETE ON tracks
+    REFERENCING OLD TABLE AS old_tracks
+    FOR EACH STATEMENT EXECUTE PROCEDURE tracks_site_stats();
+""".format(spheroid=SPHEROID,
+           simplify=''.join(
+               "    NEW.{0} := ST_Simplify(NEW.points, {1!r}, true);\n".format(
+                   column, tolerance)
+               for tolerance, column in Track.SIMPLIFIED)))
+
+RECALCULATE_SITE_STATS = """
+UPDATE site_stats SET
+    ncontributors = (SELECT count(DISTINCT user_pk) FROM tracks),
+    length = (SELECT coalesce(sum(length), 0) FROM tracks)
+"""
+
+
+def _padded_prefix_sql(t):
+    """
+    SQL for the sum of the first @t (an SQL expression) vels of a
+    reflection padded track, where index 0 is the first unpadded vel. See
+    processing.track.smooth().
+
+    ps[i + 1] is the sum of the first i unpadded vels and n is their count.
+    """
+
+    return ("CASE WHEN {t} < 0 THEN ps[2] - ps[2 - ({t})] "
+            "WHEN {t} > n THEN 2 * ps[n + 1] - ps[2 * n - ({t}) + 1] "
+            "ELSE ps[({t}) + 1] END").format(t=t)
+
+
+def _smooth_sql(window_len):
+    """
+    SQL for the flat window smoothing of vels with a window of
+    @window_len (an SQL expression), see processing.track.smooth_segments()
+    """
+
+    window_len = '({0})'.format(window_len)
+
+    # the window for vel k covers padded vels [k - w + w / 2, k + w / 2)
+    return ("CASE WHEN {w} < 3 OR n < {w} THEN vel "
+            "ELSE ({hi} - {lo}) / {w} END").format(
+                w=window_len,
+                hi=_padded_prefix_sql('k + {w} / 2'.format(w=window_len)),
+                lo=_padded_prefix_sql('k - {w} + {w} / 2'.format(
+                    w=window_len)))
+
+
+# The anomalies of processing.binning.Grid calculated in the database.
+# Each step mirrors processing.track.Track.calculate_vels() and
+# Grid.add_track(), so that only the aggregated cells are returned. {ids}
+# is the query selecting the ids of the tracks to aggregate.
+GRID_AGGREGATE = """
+WITH points AS (
+    SELECT track, i, lon, lat, ST_X(p) AS x, ST_Y(p) AS y, ms
+    FROM (SELECT id AS track, (d).path[1] AS i,
+                 ST_X((d).geom) AS lon, ST_Y((d).geom) AS lat,
+                 ST_Transform((d).geom, :utm_srid) AS p,
+                 round(ST_M((d).geom) * 1000) AS ms
+          FROM (SELECT id, ST_DumpPoints(points) AS d
+                FROM tracks WHERE id IN ({{ids}})) AS dumped) AS projected
+),
+deltas AS (
+    SELECT track, i, lon, lat, x, y,
+           y - lag(y) OVER w AS rise,
+           x - lag(x) OVER w AS run,
+           floor((ms - lag(ms) OVER w) / 1000) AS dt
+    FROM points
+    WINDOW w AS (PARTITION BY track ORDER BY i)
+),
+vels AS (
+    SELECT track, lon, lat, x, y,
+           row_number() OVER (PARTITION BY track ORDER BY i) - 1 AS k,
+           count(*) OVER (PARTITION BY track) AS n,
+           sqrt(rise * rise + run * run) / dt * 3.6 AS vel,
+           atan2(rise, run) AS theta
+    FROM deltas
+    WHERE dt <> 0
+),
+prefixes AS (
+    SELECT track, array_prepend(0::float8, array_agg(cum ORDER BY k)) AS ps
+    FROM (SELECT track, k,
+                 sum(vel) OVER (PARTITION BY track ORDER BY k) AS cum
+          FROM vels) AS cumulative
+    GROUP BY track
+),
+smoothed AS (
+    SELECT lon, lat, x, y,
+           90 - degrees(theta) AS bearing,
+           {long} AS longsmoo,
+           {short} AS shortsmoo
+    FROM vels JOIN prefixes USING (track)
+),
+reference AS (
+    SELECT ST_X(p) AS refx, ST_Y(p) AS refy
+    FROM (SELECT ST_Transform(ST_SetSRID(ST_MakePoint(:reflon, :reflat),
+                                         4326), :utm_srid) AS p) AS projected
+),
+binned AS (
+    SELECT CASE WHEN beta - 90 < bearing AND bearing <= beta + 90
+                THEN :inbound ELSE :outbound END AS direction,
+           width_bucket(lat, CAST(:yedges AS float8[])) - 1 AS ybin,
+           width_bucket(lon, CAST(:xedges AS float8[])) - 1 AS xbin,
+           CASE WHEN longsmoo <> 0 THEN (shortsmoo - longsmoo) / longsmoo
+                WHEN shortsmoo = 0 THEN 'NaN'::float8
+                ELSE sign(shortsmoo) * 'Infinity'::float8 END AS anom
+    FROM (SELECT lon, lat, longsmoo, shortsmoo,
+                 bearing - 360 * floor(bearing / 360) AS bearing,
+                 beta - 360 * floor(beta / 360) AS beta
+          FROM (SELECT lon, lat, longsmoo, shortsmoo, bearing,
+                       90 - degrees(atan2(refy - y, refx - x)) AS beta
+                FROM smoothed, reference) AS unwrapped) AS wrapped
+)
+SELECT direction, ybin, xbin, sum(anom), count(*)
+FROM binned
+GROUP BY direction, ybin, xbin
+""".format(long=_smooth_sql('n / 2'), short=_smooth_sql('11'))
+
+# Range partition tracks by date, see Track.partition(). The constraints
+# and indexes are only added once the tracks have been moved across.
+PARTITION_INTERVALS = ('year', 'month')
+
+PARTITION_TRACKS_CREATE = """
+ALTER TABLE tracks RENAME TO tracks_unpartitioned;
+
+CREATE TABLE tracks (LIKE tracks_unpartitioned INCLUDING DEFAULTS)
+    PARTITION BY RANGE (date);
+CREATE TABLE tracks_default PARTITION OF tracks DEFAULT;
+"""
+
+PARTITION_TRACKS_MOVE = """
+INSERT INTO tracks SELECT * FROM tracks_unpartitioned;
+
+ALTER SEQUENCE tracks_id_seq OWNED BY tracks.id;
+DROP TABLE tracks_unpartitioned;
+
+-- unique constraints must include the partition key
+ALTER TABLE tracks
+    ADD CONSTRAINT tracks_pkey PRIMARY KEY (id, date),
+    ADD CONSTRAINT tracks_user_pk_track_id_key
+        UNIQUE (user_pk, track_id, date),
+    ADD FOREIGN KEY (user_pk) REFERENCES users (id);
+
+CREATE INDEX ix_tracks_user_pk_date ON tracks (user_pk, date);
+CREATE INDEX ix_tracks_date ON tracks (date);
+CREATE INDEX idx_tracks_points ON tracks USING GIST (points);
+"""
+
+# Create a partition for the tracks in the default partition from
+# %(lower)s to %(upper)s. The rows are moved between the partitions
+# themselves, so the site_stats triggers on tracks don't see them.
+PARTITION_TRACKS_SPLIT_DEFAULT = """
+CREATE TABLE {0} (LIKE tracks INCLUDING DEFAULTS);
+
+INSERT INTO {0} SELECT * FROM tracks_default
+    WHERE date >= %(lower)s AND date < %(upper)s;
+DELETE FROM tracks_default WHERE date >= %(lower)s AND date < %(upper)s;
+
+ALTER TABLE tracks ATTACH PARTITION {0}
+    FOR VALUES FROM (%(lower)s) TO (%(upper)s);
+"""
+
+
+def _partition_on_create(target, connection, **kwargs):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    if app.config.get('TRACKS_PARTITION'):
+        # site_stats might not exist yet, but tracks is empty anyway
+        _partition_tracks(connection, None, recalculate=False)
+
+
+event.listen(SiteStats.__table__, 'after_create',
+             DDL("INSERT INTO site_stats (id, ncontributors, length) "
+                 "VALUES (1, 0, 0)").execute_if(dialect='postgresql'))
+event.listen(Track.__table__, 'after_create',
+             TRACK_TRIGGERS.execute_if(dialect='postgresql'))
+event.listen(Track.__table__, 'after_create', _partition_on_create)
@@ -39,10 +39,43 @@ class Grid(np.ndarray):
 
     def __new__(cls, tracks, xnum=100, ynum=100, refpoint=MELBOURNE):
 
-        minlat, maxlat, minlon, maxlon = cls.calculate_bounds(tracks)
+        self = cls._empty(cls.calculate_bounds(tracks), xnum, ynum, refpoint)
+
+        for track in tracks:
+            self.add_track(track, recalculate=False)
+
+        self._recalculate()
+
+        return self
+
+    @classmethod
+    def from_cells(cls, bounds, cells, xnum=100, ynum=100,
+                   refpoint=MELBOURNE):
+        """
+        Create from already aggregated cells, e.g. from the database.
+
+        @bounds is (minlat, maxlat, minlon, maxlon) and @cells is an
+        iterable of (direction, ybin, xbin, total anomaly, count).
+        """
+
+        self = cls._empty(bounds, xnum, ynum, refpoint)
+
+        cells = np.array(list(cells), dtype=float).reshape(-1, 5)
+        d, ybins, xbins = cells[:, :3].astype(int).T
+
+        np.add.at(self._elems_total, (d, ybins, xbins), cells[:, 3])
+        np.add.at(self._nelems, (d, ybins, xbins), cells[:, 4].astype(int))
+
+        self._recalculate()
+
+        return self
+
+    @classmethod
+    def _empty(cls, bounds, xnum, ynum, refpoint):
+        minlat, maxlat, minlon, maxlon = bounds
 
         # initialise ourselves
-        self = np.zeros((2, xnum, ynum)).view(Grid)
+        self = np.zeros((2, xnum, ynum)).view(cls)
 
         self._elems_total = np.zeros((2, xnum, ynum))
         self._nelems = np.zeros((2, xnum, ynum), dtype=int)
@@ -51,46 +84,48 @@ class Grid(np.ndarray):
         self.x = np.linspace(minlon, maxlon, num=xnum)
         self.y = np.linspace(minlat, maxlat, num=ynum)
 
-        for track in tracks:
-            self.add_track(track, recalculate=False)
-
-        self._recalculate()
-
         return self
 
     def bin_direction(self, point, bearing=None, utm_zone=55):
-        p = Proj(proj='utm', zone=utm_zone, ellps='WGS84')
-
         if bearing is None:
             bearing = point.bearing
 
+        return self.bin_directions(point.lat, point.lon, bearing,
+                                   utm_zone=utm_zone)[()]
+
+    def bin_directions(self, lats, lons, bearings, utm_zone=55):
+        """
+        Classify an array of points as INBOUND or OUTBOUND relative to
+        self.refpoint. All of the points are projected in a single call.
+        """
+
+        p = Proj(proj='utm', zone=utm_zone, ellps='WGS84')
+
         refx, refy = p(self.refpoint.lon, self.refpoint.lat)
-        px, py = p(point.lon, point.lat)
+        px, py = p(np.asarray(lons), np.asarray(lats))
 
         rise = refy - py
         run = refx - px
 
-        dist = np.sqrt(rise ** 2 + run ** 2)
         theta = np.arctan2(rise, run)
 
         beta = (90 - np.rad2deg(theta)) % 360
 
-        if beta - 90 < bearing <= beta + 90:
-            return Direction.INBOUND
-        else:
-            return Direction.OUTBOUND
+        inbound = (beta - 90 < bearings) & (bearings <= beta + 90)
+
+        return np.where(inbound, Direction.INBOUND, Direction.OUTBOUND)
 
     def add_track(self, track, recalculate=True):
         vels = track.calculate_vels()
         xbins = np.digitize(vels.lon, self.x) - 1
         ybins = np.digitize(vels.lat, self.y) - 1
 
-        for (x, y, vel) in zip(xbins, ybins, vels):
-            d = self.bin_direction(vel)
+        d = self.bin_directions(vels.lat, vels.lon, vels.bearing)
 
-            # rows, columns
-            self._elems_total[d, y, x] += vel.anom
-            self._nelems[d, y, x] += 1
+        # rows, columns
+        # np.add.at is unbuffered, so repeated cells accumulate in order
+        np.add.at(self._elems_total, (d, ybins, xbins), vels.anom)
+        np.add.at(self._nelems, (d, ybins, xbins), 1)
 
         if recalculate:
             self._recalculate()
@@ -0,0 +1,70 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Danielle Madeley <danielle@madeley.id.au>
+
+import hashlib
+
+import numpy as np
+
+from cyclerouter.util import CacheDirectory
+
+
+class TrackCache(CacheDirectory):
+    """
+    A content-addressed on-disk cache of parsed tracks.
+
+    Tracks are keyed by the hash of their source file, the parser class and
+    its VERSION, and stored as .npy files which are reopened memory-mapped.
+    Bumping a parser's VERSION means its old entries are never hit again;
+    they are evicted, least recently used first, once the cache grows past
+    max_size bytes.
+    """
+
+    SUFFIX = '.npy'
+
+    def __init__(self, path='track-cache', max_size=256 * 1024 * 1024):
+        super(TrackCache, self).__init__(path, max_size)
+
+    def key(self, cls, filename):
+        """
+        The cache key for parsing @filename with @cls.
+        """
+
+        h = hashlib.sha1()
+
+        with open(filename, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 16), b''):
+                h.update(block)
+
+        return '{}-{}-{}'.format(cls.__name__, cls.VERSION, h.hexdigest())
+
+    def load(self, cls, filename):
+        """
+        Return @filename parsed with @cls, from the cache if possible.
+
+        Cached tracks are read-only memory maps.
+        """
+
+        cachefile = self._path(self.key(cls, filename))
+
+        try:
+            track = np.load(cachefile, mmap_mode='r')
+            self._touch(cachefile)
+        except IOError:
+            with open(filename, 'rb') as fp:
+                track = np.asarray(cls(fp))
+
+            self._store(cachefile, lambda fp: np.save(fp, track))
+
+        return track.view(cls)
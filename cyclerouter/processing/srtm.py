@@ -13,7 +13,10 @@
 #
 # Authors: Danielle Madeley <danielle@madeley.id.au>
 
+from collections import OrderedDict
 from contextlib import contextmanager
+import json
+import os.path
 
 import gdal
 import numpy as np
@@ -23,6 +26,8 @@ from numpy.testing import assert_almost_equal
 
 MIN_INT16 = -2**15
 
+DEFAULT_GRIDFILE = '3sSRTM_2008_DEM_ESRI_GRID_3sx3s_Mosaic/dem3s_int'
+
 @contextmanager
 def GDAL_Open(*args, **kwargs):
     """
@@ -38,27 +43,181 @@ def GDAL_Open(*args, **kwargs):
 class OutOfBounds(Exception):
     pass
 
-class SRTM(ma.MaskedArray):
+class ElevationGrid(object):
+    """
+    Lookups common to the different ways of loading SRTM data.
+
+    Subclasses set lats, lons and binsize (see _georeference) and support
+    indexing by [row, column].
+    """
+
+    def _georeference(self, ds):
+        # assert we only have one layer
+        assert ds.RasterCount == 1, "Expected only one layer in grid"
+
+        self._set_geotransform(ds.GetGeoTransform(),
+                               (ds.RasterYSize, ds.RasterXSize))
+
+    def _set_geotransform(self, geotransform, shape):
+        originx, sizex, _, originy, _, sizey = geotransform
+        nrows, ncols = shape
+
+        # ensure regular grid
+        assert sizex == -sizey, "Grid not regular or correct orientation"
+
+        self.binsize = sizex
+
+        self.lats = np.linspace(originy, originy + nrows * sizey,
+                                num=nrows, endpoint=False)
+        self.lons = np.linspace(originx, originx + ncols * sizex,
+                                num=ncols, endpoint=False)
+
+    def _lookup(self, lats, lons):
+        """
+        Returns the row and column indices into the grid for arrays of
+        latitudes and longitudes, and a mask of which points are within the
+        grid. Indices of out of bounds points are clamped to the grid.
+        """
+
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+
+        # origin of grid is top-left
+        #
+        # because the origin is top-left, lats is backwards to the order we
+        # can search in, so search a reversed view instead
+        ascending_lats = self.lats[::-1]
+
+        inbounds = (ascending_lats[0] <= lats) & \
+                   (lats <= ascending_lats[-1]) & \
+                   (self.lons[0] <= lons) & (lons <= self.lons[-1])
+
+        r = np.searchsorted(ascending_lats, lats)
+        c = np.searchsorted(self.lons, lons)
+
+        # convert the row back into the original orientation
+        r = len(self.lats) - 1 - np.clip(r, 0, len(self.lats) - 1)
+        c = np.clip(c, 0, len(self.lons) - 1)
+
+        return r, c, inbounds
+
+    def extract_point(self, lat, lon):
+        """
+        Extract a single point of data by latitude, longitude.
+        """
+
+        if not self.lats[-1] <= lat <= self.lats[0]:
+            raise OutOfBounds("Latitude {} not in range [{}, {}]".format(
+                lat, self.lats[-1], self.lats[0]))
+        elif not self.lons[0] <= lon <= self.lons[-1]:
+            raise OutOfBounds("Longitude {} not in range [{}, {}]".format(
+                lon, self.lons[0], self.lons[-1]))
+
+        r, c, _ = self._lookup(lat, lon)
+
+        return self[r, c]
+
+    def extract_points(self, lats, lons, method='nearest'):
+        """
+        Extract the data for arrays of latitudes and longitudes.
+
+        @method is 'nearest' or 'bilinear'.
+
+        Returns a masked array, points outside of the grid or without data
+        are masked.
+        """
+
+        if method == 'bilinear':
+            return self._interpolate(lats, lons)
+        elif method != 'nearest':
+            raise ValueError("Unknown method '{}'".format(method))
+
+        r, c, inbounds = self._lookup(lats, lons)
+
+        elevs = self[r, c].view(ma.MaskedArray)
+        elevs.mask = ma.getmaskarray(elevs) | ~inbounds
+
+        return elevs
+
+    def _interpolate(self, lats, lons):
+        """
+        Bilinear interpolation of arrays of latitudes and longitudes.
+
+        Corners without data are left out and the remaining weights
+        renormalised, points with no valid corners are masked.
+        """
+
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+
+        nrows, ncols = len(self.lats), len(self.lons)
+
+        # fractional row and column, the origin of the grid is top-left
+        fr = (self.lats[0] - lats) / self.binsize
+        fc = (lons - self.lons[0]) / self.binsize
+
+        inbounds = (0 <= fr) & (fr <= nrows - 1) & \
+                   (0 <= fc) & (fc <= ncols - 1)
+
+        fr = np.where(inbounds, fr, 0)
+        fc = np.where(inbounds, fc, 0)
+
+        r0 = np.clip(np.floor(fr), 0, max(nrows - 2, 0)).astype(int)
+        c0 = np.clip(np.floor(fc), 0, max(ncols - 2, 0)).astype(int)
+
+        dr = fr - r0
+        dc = fc - c0
+
+        total = np.zeros(lats.shape)
+        weights = np.zeros(lats.shape)
+
+        for r, c, w in [(r0, c0, (1 - dr) * (1 - dc)),
+                        (r0, c0 + 1, (1 - dr) * dc),
+                        (r0 + 1, c0, dr * (1 - dc)),
+                        (r0 + 1, c0 + 1, dr * dc)]:
+
+            r = np.minimum(r, nrows - 1)
+            c = np.minimum(c, ncols - 1)
+
+            values = ma.asarray(self[r, c])
+            valid = ~ma.getmaskarray(values)
+
+            total += np.where(valid, values.filled(0) * w, 0)
+            weights += np.where(valid, w, 0)
+
+        mask = ~inbounds | (weights == 0)
+
+        return ma.array(total / np.where(mask, 1, weights), mask=mask)
+
+    def extract_track(self, track, method='nearest'):
+        """
+        Extracts the elevation data for a track.
+        """
+
+        return self.extract_points(track.lat, track.lon, method=method)
+
+class SRTM(ElevationGrid, ma.MaskedArray):
     """
     Loads Geoscience Australia SRTM DEM data from ESRI grid format.
+
+    Pass lazy=True to get a LazySRTM, which only reads the parts of the grid
+    that are used, or mmap=True to open a grid converted with convert_grid()
+    as a MappedSRTM.
     """
 
-    def __new__(cls,
-                gridfile='3sSRTM_2008_DEM_ESRI_GRID_3sx3s_Mosaic/dem3s_int'):
+    def __new__(cls, gridfile=DEFAULT_GRIDFILE, lazy=False, mmap=False,
+                **kwargs):
+
+        if lazy:
+            return LazySRTM(gridfile, **kwargs)
+        elif mmap:
+            return MappedSRTM(gridfile, **kwargs)
 
         with GDAL_Open(gridfile, GA_ReadOnly) as ds:
 
             # FIXME: do we need to handle this somehow?
             # print ds.GetProjection()
 
-            originx, sizex, _, originy, _, sizey = ds.GetGeoTransform()
-
-            # ensure regular grid
-            assert sizex == -sizey, "Grid not regular or correct orientation"
-
-            # assert we only have one layer
-            assert ds.RasterCount == 1, "Expected only one layer in grid"
-
             band = ds.GetRasterBand(1)
             data = band.ReadAsArray()
 
@@ -66,49 +225,333 @@ class SRTM(ma.MaskedArray):
             mask = (data == MIN_INT16)
 
             self = ma.array(data, mask=mask).view(cls)
-
-            self.binsize = sizex
-
-            self.lats = np.linspace(originy, originy + ds.RasterYSize * sizey,
-                                    num=ds.RasterYSize, endpoint=False)
-            self.lons = np.linspace(originx, originx + ds.RasterXSize * sizex,
-                                    num=ds.RasterXSize, endpoint=False)
+            self._georeference(ds)
 
             return self
 
     def __repr__(self):
         return '{}()'.format(self.__class__.__name__)
 
+class LazySRTM(ElevationGrid):
+    """
+    SRTM data read on demand from the grid file, one GDAL raster block at a
+    time. The most recently used blocks are kept in memory, up to cache_size
+    bytes.
+
+    Supports the same lookups as SRTM, and indexing by [row, column] which
+    returns masked arrays.
+    """
+
+    def __init__(self, gridfile=DEFAULT_GRIDFILE, cache_size=64 * 1024 * 1024):
+
+        self.gridfile = gridfile
+        self.ds = gdal.Open(gridfile, GA_ReadOnly)
+        self.band = self.ds.GetRasterBand(1)
+
+        self._georeference(self.ds)
+
+        self.shape = (self.ds.RasterYSize, self.ds.RasterXSize)
+        self.ndim = 2
+
+        self.block_width, self.block_height = self.band.GetBlockSize()
+        self.nblocks_x = -(-self.shape[1] // self.block_width)
+
+        block_bytes = self.block_width * self.block_height * \
+                      np.dtype(np.int16).itemsize
+        self.max_blocks = max(1, cache_size // block_bytes)
+        self.blocks = OrderedDict()
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.gridfile)
+
+    def _block(self, by, bx):
+        """
+        Returns block (by, bx) as a masked array.
+        """
+
+        key = (by, bx)
+
+        try:
+            block = self.blocks.pop(key)
+        except KeyError:
+            xoff = bx * self.block_width
+            yoff = by * self.block_height
+            xsize = min(self.block_width, self.shape[1] - xoff)
+            ysize = min(self.block_height, self.shape[0] - yoff)
+
+            data = self.band.ReadAsArray(xoff, yoff, xsize, ysize)
+            block = ma.array(data, mask=(data == MIN_INT16))
+
+            while len(self.blocks) >= self.max_blocks:
+                self.blocks.popitem(last=False)
+
+        # (re)insert as the most recently used
+        self.blocks[key] = block
+
+        return block
+
+    def _values(self, r, c):
+        """
+        Returns the values at arrays of rows and columns, reading each block
+        they touch once.
+        """
+
+        values = ma.masked_all(r.shape, dtype=np.int16)
+
+        rflat = r.ravel()
+        cflat = c.ravel()
+        out = values.reshape(-1)
+
+        by = rflat // self.block_height
+        bx = cflat // self.block_width
+        keys = by * self.nblocks_x + bx
+
+        # group the points by block
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+
+        for group in np.split(order, bounds):
+            gy, gx = by[group[0]], bx[group[0]]
+            block = self._block(gy, gx)
+
+            out[group] = block[rflat[group] - gy * self.block_height,
+                               cflat[group] - gx * self.block_width]
+
+        return values
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+
+        rkey, ckey = key
+
+        r = np.arange(self.shape[0])[rkey]
+        c = np.arange(self.shape[1])[ckey]
+
+        if isinstance(rkey, slice) and isinstance(ckey, slice):
+            r, c = np.ix_(r, c)
+
+        r, c = np.broadcast_arrays(r, c)
+
+        values = self._values(r, c)
+
+        if values.ndim == 0:
+            return values[()]
+
+        return values
+
+class MappedSRTM(ElevationGrid):
+    """
+    SRTM data memory-mapped from a raw file written by convert_grid().
+
+    Processes opening the same file share its pages through the OS page
+    cache. The no-data mask is only computed for the values looked up.
+    """
+
+    def __init__(self, rawfile):
+
+        self.rawfile = rawfile
+
+        with open(sidecar_filename(rawfile)) as fp:
+            meta = json.load(fp)
+
+        self.shape = tuple(meta['shape'])
+        self.ndim = 2
+        self.nodata = meta['nodata']
+
+        self.data = np.memmap(rawfile, dtype=meta['dtype'], mode='r',
+                              shape=self.shape)
+
+        self._set_geotransform(meta['geotransform'], self.shape)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.rawfile)
+
+    def __getitem__(self, key):
+        data = np.asarray(self.data[key])
+
+        if data.ndim == 0:
+            return ma.masked if data == self.nodata else data[()]
+
+        return ma.array(data, mask=(data == self.nodata))
+
+class SRTMMosaic(object):
+    """
+    Many SRTM tiles, indexed by their bounding boxes.
+
+    Lookups are routed to the tile that contains each point. Tiles are
+    opened, by default lazily, the first time they are needed and at most
+    max_open are kept open. Where tiles overlap, the first listed wins.
+
+    As with the SRTM 1 degree tiles, neighbouring tiles are expected to share
+    their edge rows and columns; points between two tiles that don't are
+    masked.
+
+    Tiles converted with convert_grid() (those with a sidecar) are opened as
+    MappedSRTM, the rest with GDAL as SRTM(tile, **kwargs).
+    """
+
+    def __init__(self, tiles, max_open=4, **kwargs):
+
+        self.tiles = list(tiles)
+        self.max_open = max_open
+        self.kwargs = kwargs or dict(lazy=True)
+
+        self.bounds = np.array([tile_bounds(t) for t in self.tiles],
+                               dtype=float).reshape(-1, 4)
+        self.open_tiles = OrderedDict()
+
+    def __repr__(self):
+        return '{}({} tiles)'.format(self.__class__.__name__,
+                                     len(self.tiles))
+
+    def tile(self, i):
+        """
+        Returns tile i, opening it if required.
+        """
+
+        try:
+            grid = self.open_tiles.pop(i)
+        except KeyError:
+            tile = self.tiles[i]
+
+            if os.path.exists(sidecar_filename(tile)):
+                grid = MappedSRTM(tile)
+            else:
+                grid = SRTM(tile, **self.kwargs)
+
+            while len(self.open_tiles) >= self.max_open:
+                self.open_tiles.popitem(last=False)
+
+        self.open_tiles[i] = grid
+
+        return grid
+
+    def _route(self, lats, lons):
+        """
+        Returns the index of the tile containing each point, or -1.
+        """
+
+        tiles = np.empty(lats.shape, dtype=int)
+        tiles.fill(-1)
+
+        if lats.size == 0:
+            return tiles
+
+        minlat, maxlat, minlon, maxlon = self.bounds.T
+
+        # only consider the tiles that overlap the points
+        candidates = np.flatnonzero((minlat <= np.nanmax(lats)) &
+                                    (maxlat >= np.nanmin(lats)) &
+                                    (minlon <= np.nanmax(lons)) &
+                                    (maxlon >= np.nanmin(lons)))
+
+        for i in candidates:
+            inside = (tiles < 0) & \
+                     (minlat[i] <= lats) & (lats <= maxlat[i]) & \
+                     (minlon[i] <= lons) & (lons <= maxlon[i])
+
+            tiles[inside] = i
+
+        return tiles
+
     def extract_point(self, lat, lon):
         """
         Extract a single point of data by latitude, longitude.
         """
 
-        # origin of grid is top-left
-        #
-        # because the origin is top-left, lats is backwards to the order we
-        # can search in
+        i = self._route(np.asarray(lat, dtype=float),
+                        np.asarray(lon, dtype=float))[()]
 
-        lats = np.flipud(self.lats)
-        lons = self.lons
+        if i < 0:
+            raise OutOfBounds("({}, {}) not in any tile".format(lat, lon))
 
-        if not lats[0] <= lat <= lats[-1]:
-            raise OutOfBounds("Latitude {} not in range [{}, {}]".format(
-                lat, lats[0], lats[-1]))
-        elif not lons[0] <= lon <= lons[-1]:
-            raise OutOfBounds("Longitude {} not in range [{}, {}]".format(
-                lon, lons[0], lons[-1]))
+        return self.tile(i).extract_point(lat, lon)
+
+    def extract_points(self, lats, lons, method='nearest'):
+        """
+        Extract the data for arrays of latitudes and longitudes, see
+        ElevationGrid.extract_points. Each tile is read once per call.
+        """
+
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
 
+        tiles = self._route(lats, lons)
+        elevs = ma.masked_all(lats.shape, dtype=float)
 
-        r = np.searchsorted(lats, lat)
-        c = np.searchsorted(lons, lon)
+        for i in np.unique(tiles[tiles >= 0]):
+            inside = tiles == i
 
-        # flip the data to match the latitudes
-        return np.flipud(self)[r, c]
+            elevs[inside] = self.tile(i).extract_points(lats[inside],
+                                                        lons[inside],
+                                                        method=method)
 
-    def extract_track(self, track):
+        return elevs
+
+    def extract_track(self, track, method='nearest'):
         """
         Extracts the elevation data for a track.
         """
 
-        return np.array([ self.extract_point(*p) for p in zip(track.lat, track.lon) ])
+        return self.extract_points(track.lat, track.lon, method=method)
+
+def tile_bounds(filename):
+    """
+    Returns (minlat, maxlat, minlon, maxlon) of a grid file or converted
+    raw file, without reading its data.
+    """
+
+    try:
+        with open(sidecar_filename(filename)) as fp:
+            meta = json.load(fp)
+
+        geotransform = meta['geotransform']
+        nrows, ncols = meta['shape']
+    except IOError:
+        with GDAL_Open(filename, GA_ReadOnly) as ds:
+            geotransform = ds.GetGeoTransform()
+            nrows, ncols = ds.RasterYSize, ds.RasterXSize
+
+    originx, sizex, _, originy, _, sizey = geotransform
+
+    # the bounds of the grid points, as used by ElevationGrid._lookup
+    return (originy + (nrows - 1) * sizey, originy,
+            originx, originx + (ncols - 1) * sizex)
+
+def sidecar_filename(rawfile):
+    """
+    The georeferencing metadata for @rawfile.
+    """
+
+    return rawfile + '.json'
+
+def convert_grid(gridfile, rawfile, rows=256):
+    """
+    Convert an SRTM grid to a raw int16 file that can be opened with
+    MappedSRTM, reading @rows rows at a time.
+    """
+
+    with GDAL_Open(gridfile, GA_ReadOnly) as ds:
+
+        assert ds.RasterCount == 1, "Expected only one layer in grid"
+
+        shape = (ds.RasterYSize, ds.RasterXSize)
+        band = ds.GetRasterBand(1)
+
+        out = np.memmap(rawfile, dtype=np.int16, mode='w+', shape=shape)
+
+        for yoff in range(0, shape[0], rows):
+            nrows = min(rows, shape[0] - yoff)
+            out[yoff:yoff + nrows] = band.ReadAsArray(0, yoff,
+                                                      shape[1], nrows)
+
+        out.flush()
+        del out
+
+        with open(sidecar_filename(rawfile), 'w') as fp:
+            json.dump(dict(geotransform=ds.GetGeoTransform(),
+                           shape=shape,
+                           dtype='int16',
+                           nodata=MIN_INT16), fp)
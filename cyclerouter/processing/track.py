@@ -14,6 +14,7 @@
 # Authors: Danielle Madeley <danielle@madeley.id.au>
 
 from datetime import datetime, timedelta
+from itertools import islice
 import json
 from math import pi
 
@@ -24,6 +25,22 @@ import numpy as np
 class BadInputException(Exception):
     pass
 
+# above this window length, non-flat windows are convolved using the FFT
+FFT_WINDOW_LEN = 64
+
+def _fftconvolve(w, s):
+    """
+    Equivalent to np.convolve(w, s, mode='valid') for len(w) <= len(s), but
+    O(n log n) in the window length.
+    """
+
+    n = s.size + w.size - 1
+    nfft = 1 << (n - 1).bit_length()
+
+    y = np.fft.irfft(np.fft.rfft(s, nfft) * np.fft.rfft(w, nfft), nfft)
+
+    return y[w.size - 1:s.size]
+
 def smooth(x, window_len=11, window='flat'):
     """
     Adapted from http://www.scipy.org/Cookbook/SignalSmooth
@@ -39,26 +56,114 @@ def smooth(x, window_len=11, window='flat'):
     s = np.r_[x[window_len - 1:0:-1],x,x[-1:-window_len:-1]]
 
     if window == 'flat':
-        w = np.ones(window_len, 'd')
+        # running mean from the cumulative sum, this is O(n) regardless of
+        # the window length
+        c = np.cumsum(np.r_[0., s])
+        y = (c[window_len:] - c[:-window_len]) / window_len
     else:
         w = getattr(np, window)(window_len)
+        w = w / w.sum()
 
-    y = np.convolve(w / w.sum(), s, mode='valid')
+        if window_len > FFT_WINDOW_LEN:
+            y = _fftconvolve(w, s)
+        else:
+            y = np.convolve(w, s, mode='valid')
 
     return y[window_len / 2 - 1:-window_len / 2]
 
+def smooth_segments(x, offsets, window_lens=11):
+    """
+    Flat window smoothing of many segments of @x at once, where segment i
+    is x[offsets[i]:offsets[i + 1]]. Each segment is reflection-padded on its
+    own, so the smoothing never crosses a segment boundary.
+
+    @window_lens is either a single window length or one per segment.
+    Segments shorter than their window (or with a window shorter than 3)
+    are returned unsmoothed.
+    """
+
+    offsets = np.asarray(offsets)
+    lens = np.diff(offsets)
+    window_lens = np.broadcast_to(window_lens, lens.shape).astype(int)
+
+    y = np.array(x, dtype=float)
+
+    smoothed = (window_lens >= 3) & (lens >= window_lens)
+
+    starts = offsets[:-1][smoothed]
+    n = lens[smoothed]
+    w = window_lens[smoothed]
+
+    if not smoothed.any():
+        return y
+
+    # build the reflection-padded segments end to end, see smooth()
+    padded_lens = n + 2 * (w - 1)
+    padded_offsets = np.r_[0, np.cumsum(padded_lens)]
+
+    j = np.arange(padded_offsets[-1]) - \
+        np.repeat(padded_offsets[:-1] + w - 1, padded_lens)
+    seg_n = np.repeat(n, padded_lens)
+
+    idx = np.where(j < 0, -j, np.where(j >= seg_n, 2 * seg_n - 1 - j, j))
+    s = x[idx + np.repeat(starts, padded_lens)]
+
+    c = np.cumsum(np.r_[0., s])
+
+    # the first padded sample in the window for each output sample
+    m = np.arange(n.sum()) - np.repeat(np.r_[0, np.cumsum(n)][:-1], n)
+    first = np.repeat(padded_offsets[:-1] + w / 2 - 1, n) + m
+    seg_w = np.repeat(w, n)
+
+    out = np.repeat(starts, n) + m
+    y[out] = (c[first + seg_w] - c[first]) / seg_w
+
+    return y
+
+def _split_utc_offset(timestamp):
+    """
+    Split an ISO 8601 timestamp into its local time and UTC offset (in
+    minutes), suitable for decoding with numpy.
+    """
+
+    if timestamp.endswith('Z'):
+        return timestamp[:-1], 0
+    elif timestamp[-6] in '+-' and timestamp[-3] == ':':
+        sign = -1 if timestamp[-6] == '-' else 1
+        offset = int(timestamp[-5:-3]) * 60 + int(timestamp[-2:])
+
+        return timestamp[:-6], sign * offset
+    else:
+        # no timezone, assume UTC
+        return timestamp, 0
+
 class Track(np.recarray):
 
-    def __new__(cls, fp):
-        track = list(cls._parse(fp))
+    # times are stored natively as milliseconds since the epoch (UTC), so
+    # that deltas, sorting and windowing don't go through Python objects
+    DTYPE = [('lat', float),
+             ('lon', float),
+             ('elev', float),
+             ('time', 'datetime64[ms]'),
+            ]
+
+    VERSION = 0
 
+    def __new__(cls, fp, **kwargs):
         # initialise ourselves as a recarray
-        return np.array(track,
-                        dtype=[('lat', float),
-                               ('lon', float),
-                               ('elev', float),
-                               ('time', datetime),
-                              ]).view(cls)
+        return cls._read(fp, **kwargs).view(cls)
+
+    @classmethod
+    def _read(cls, fp, limit=None):
+        """
+        Read at most @limit points from @fp into a structured array.
+
+        The default implementation collects the tuples from _parse().
+        """
+
+        track = list(islice(cls._parse(fp), limit))
+
+        return np.array(track, dtype=cls.DTYPE)
 
     def _parse(cls, fp):
         raise NotImplemented()
@@ -77,9 +182,9 @@ class Track(np.recarray):
         dist = np.sqrt(rise ** 2 + run ** 2)
         theta = np.arctan2(rise, run)
 
-        # calculate the time deltas between consecutive points
-        seconds = np.vectorize(lambda td: td.seconds)
-        times = seconds(self.time[1:] - self.time[:-1])
+        # calculate the time deltas between consecutive points (in whole
+        # seconds)
+        times = np.diff(self.time).astype('timedelta64[s]').astype(int)
 
         valid = times.nonzero()
 
@@ -137,6 +242,10 @@ class Track(np.recarray):
 
 class GPX(Track):
 
+    # bump this when a parser change alters the parsed output, this
+    # invalidates any cached tracks (see processing.cache)
+    VERSION = 1
+
     NAMESPACES = {
         None: 'http://www.topografix.com/GPX/1/1',
         'gpxtpx': 'http://www.garmin.com/xmlschemas/TrackPointExtension/v1',
@@ -146,26 +255,80 @@ class GPX(Track):
     def elem(tag, namespace=None):
         return tag.format('{%s}' % GPX.NAMESPACES[namespace])
 
+    # initial size of the column buffers, these grow as required
+    CHUNKSIZE = 1024
+
     @classmethod
-    def _parse(cls, fp):
+    def _read(cls, fp, limit=None, chunksize=None):
+        """
+        Parse trkpts straight into typed column buffers.
+
+        Timestamps are gathered as strings and decoded by numpy in a single
+        pass at the end, rather than by strptime for every point.
+        """
+
+        size = chunksize or cls.CHUNKSIZE
+
+        if limit is not None:
+            size = min(size, limit)
+
+        lats = np.empty(size)
+        lons = np.empty(size)
+        elevs = np.empty(size)
+        times = np.empty(size, dtype='S26')
+        offsets = np.zeros(size, dtype='timedelta64[m]')
+        columns = (lats, lons, elevs, times, offsets)
+
+        trkpt = GPX.elem('{}trkpt')
+        ele = GPX.elem('{}ele')
+        time = GPX.elem('{}time')
+
+        n = 0
+
         try:
-            for _, elem in etree.iterparse(fp, tag=GPX.elem('{}trkpt')):
-                lat = float(elem.get('lat'))
-                lon = float(elem.get('lon'))
-                elev = float(elem.find(GPX.elem('{}ele')).text)
-                time = datetime.strptime(elem.find(GPX.elem('{}time')).text,
-                                         '%Y-%m-%dT%H:%M:%SZ')
+            for _, elem in etree.iterparse(fp, tag=trkpt):
+                if n == limit:
+                    break
+                elif n == size:
+                    # double the buffers, up to the limit
+                    size *= 2
+
+                    if limit is not None:
+                        size = min(size, limit)
 
-                yield (lat, lon, elev, time)
+                    for column in columns:
+                        column.resize(size, refcheck=False)
 
+                lats[n] = float(elem.get('lat'))
+                lons[n] = float(elem.get('lon'))
+                elevs[n] = float(elem.findtext(ele))
+                times[n], offsets[n] = _split_utc_offset(elem.findtext(time))
+
+                n += 1
+
+                # drop the elements we've already seen so memory use doesn't
+                # grow with the document
                 elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
         except etree.XMLSyntaxError:
             # why is this?
             pass
 
+        track = np.empty(n, dtype=cls.DTYPE)
+        track['lat'] = lats[:n]
+        track['lon'] = lons[:n]
+        track['elev'] = elevs[:n]
+        track['time'] = times[:n].astype('datetime64[ms]') - offsets[:n]
+
+        return track
+
 class RKJSON(Track):
     "RunKeeper JSON format"
 
+    VERSION = 1
+
     @classmethod
     def _parse(cls, fp):
         track = json.load(fp)
@@ -191,3 +354,113 @@ class RKJSON(Track):
             time = starttime + timedelta(seconds=point['timestamp'])
 
             yield (lat, lon, elev, time)
+
+
+class Tracks(np.recarray):
+    """
+    Many tracks stored end to end in a single array. Track i is
+    self[self.offsets[i]:self.offsets[i + 1]].
+    """
+
+    def __new__(cls, tracks):
+        lens = [len(t) for t in tracks]
+
+        self = np.concatenate([np.asarray(t, dtype=Track.DTYPE)
+                               for t in tracks]).view(cls)
+        self.offsets = np.r_[0, np.cumsum(lens)]
+
+        return self
+
+    @classmethod
+    def from_arrays(cls, arrays, offsets):
+        """
+        Create from a ragged record array and its segment offsets.
+        """
+
+        self = np.asarray(arrays).view(cls)
+        self.offsets = np.asarray(offsets)
+
+        return self
+
+    def __array_finalize__(self, obj):
+        self.offsets = getattr(obj, 'offsets', None)
+
+    @property
+    def ntracks(self):
+        return len(self.offsets) - 1
+
+    def track(self, i):
+        """
+        Returns track i as a view. This is a Track if we hold points, or a
+        plain recarray if we hold velocities.
+        """
+
+        if self.dtype == np.dtype(Track.DTYPE):
+            cls = Track
+        else:
+            cls = np.recarray
+
+        return np.asarray(self)[self.offsets[i]:self.offsets[i + 1]].view(cls)
+
+    def calculate_vels(self, smooth_vels=False, utm_zone=55):
+        """
+        Track.calculate_vels() for every track in a single pass.
+
+        Returns a Tracks of velocities, whose offsets delimit the velocities
+        of each track.
+        """
+
+        p = Proj(proj='utm', zone=utm_zone, ellps='WGS84')
+
+        x, y = p(self.lon, self.lat)
+
+        rise = y[1:] - y[:-1]
+        run = x[1:] - x[:-1]
+
+        dist = np.sqrt(rise ** 2 + run ** 2)
+        theta = np.arctan2(rise, run)
+
+        times = np.diff(self.time).astype('timedelta64[s]').astype(int)
+
+        # the delta into the first point of each track is across a track
+        # boundary
+        segment = np.repeat(np.arange(self.ntracks), np.diff(self.offsets))
+        starts = self.offsets[1:-1]
+        boundary = np.zeros(len(times), dtype=bool)
+        boundary[starts[(starts > 0) & (starts < len(self))] - 1] = True
+
+        valid = (times != 0) & ~boundary
+
+        timestamps = self.time[1:][valid]
+        lats = self.lat[1:][valid]
+        lons = self.lon[1:][valid]
+        theta = theta[valid]
+        dist = dist[valid]
+        times = times[valid]
+
+        counts = np.bincount(segment[1:][valid], minlength=self.ntracks)
+        offsets = np.r_[0, np.cumsum(counts)]
+
+        vels = (dist / times) * 3.6 # m/s to km/h
+        bearing = (90 - np.rad2deg(theta)) % 360
+
+        # see Track.calculate_vels()
+        longsmoo = smooth_segments(vels, offsets, window_lens=counts / 2)
+        shortsmoo = smooth_segments(vels, offsets)
+
+        anom = (shortsmoo - longsmoo) / longsmoo
+
+        if smooth_vels:
+            vels = shortsmoo
+
+        u = vels * np.cos(theta)
+        v = vels * np.sin(theta)
+
+        a = np.rec.fromarrays([timestamps, lats, lons,
+                               theta, bearing, dist, vels,
+                               u, v, anom],
+                              names=('time', 'lat', 'lon',
+                                     'theta', 'bearing', 'dist', 'vel',
+                                     'u', 'v', 'anom'))
+
+        return Tracks.from_arrays(a, offsets)
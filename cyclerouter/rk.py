@@ -13,16 +13,84 @@
 #
 # Authors: Danielle Madeley <danielle@madeley.id.au>
 
+import hashlib
 import json
+import random
+import socket
 import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from urllib import urlencode
 from urlparse import urlparse, parse_qs
 from tempfile import NamedTemporaryFile
+from Queue import Queue, Full
 
-from httplib2 import Http, ServerNotFoundError
+from httplib2 import Http, HttpLib2Error, Response, ServerNotFoundError
 
 from keys import * # API keys: CLIENT_ID, CLIENT_SECRET
+from util import CacheDirectory
+
+
+# the format of times in the RK API, which are local to the activity
+TIME_FORMAT = '%a, %d %b %Y %H:%M:%S'
+
+
+def parse_time(time):
+    return datetime.strptime(time, TIME_FORMAT)
+
+
+def prefetch(iterable, depth):
+    """
+    Iterate @iterable in a background thread, which runs up to @depth items
+    ahead of the caller.
+    """
+
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # give up if the caller goes away
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+
+            put((done, None))
+        except Exception:
+            put((done, sys.exc_info()))
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, exc_info = queue.get()
+
+            if item is done:
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                return
+
+            yield item
+    finally:
+        stop.set()
 
 
 class AuthenticationException(Exception):
@@ -49,8 +117,248 @@ class FileNotFound(HttpException):
     pass
 
 
-class Client(Http):
-    def request(self, uri, data={}, method='GET', headers={}, body=None):
+class ConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive connections, shared between Clients.
+
+    At most @max_per_host requests are made to each host at once, unless
+    overridden with set_limit(). Further requests block until one of those
+    finishes.
+    """
+
+    def __init__(self, max_per_host=4, timeout=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._limits = {}
+        self._slots = {}
+        self._idle = {}
+
+    @staticmethod
+    def _host(uri):
+        p = urlparse(uri)
+
+        return p.scheme, p.netloc
+
+    def set_limit(self, uri, limit):
+        """
+        Limit the concurrent requests to the host of @uri (e.g.
+        RK.API_URL) to @limit
+        """
+
+        key = self._host(uri)
+
+        with self._lock:
+            self._limits[key] = limit
+            self._slots.pop(key, None)
+
+    def _get_slots(self, key):
+        with self._lock:
+            try:
+                return self._slots[key]
+            except KeyError:
+                slots = threading.BoundedSemaphore(
+                    self._limits.get(key, self.max_per_host))
+                self._slots[key] = slots
+
+                return slots
+
+    def request(self, uri, **kwargs):
+        """
+        Make a request with an idle connection to the host of @uri, see
+        httplib2.Http.request()
+        """
+
+        key = self._host(uri)
+        slots = self._get_slots(key)
+
+        slots.acquire()
+
+        try:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                http = idle.pop() if idle else Http(timeout=self.timeout)
+
+            # a connection that failed is in an unknown state, drop it
+            resp, content = http.request(uri, **kwargs)
+
+            with self._lock:
+                idle.append(http)
+
+            return resp, content
+        finally:
+            slots.release()
+
+
+# the pool used by Clients by default, for the whole process
+POOL = ConnectionPool()
+
+
+class RateLimiter(object):
+    """
+    A thread-safe token bucket, allowing @rate requests a second on
+    average in bursts of up to @burst. If @rate is None, requests are only
+    held back by pause().
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.time()
+        self._paused_until = 0
+
+    def acquire(self):
+        """
+        Block until the next request is allowed
+        """
+
+        with self._lock:
+            now = time.time()
+            wait = self._paused_until - now
+
+            if self.rate is not None:
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+
+                # a negative balance is the queue of requests waiting
+                self._tokens -= 1
+                wait = max(wait, -self._tokens / float(self.rate))
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, delay):
+        """
+        Hold back every request for @delay seconds, e.g. after the server
+        sent Retry-After
+        """
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + delay)
+
+
+# the rate limit shared by RKs by default, the API's limits are per
+# application rather than per user
+LIMITER = RateLimiter()
+
+
+def retry_after(resp):
+    """
+    Returns the delay in seconds from @resp's Retry-After header, or None
+    """
+
+    value = resp.get('retry-after')
+
+    if value is None:
+        return None
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+
+    date = parsedate_tz(value)
+
+    if date is None:
+        return None
+
+    return max(0, mktime_tz(date) - time.time())
+
+
+class ResponseCache(CacheDirectory):
+    """
+    An on-disk cache of GET responses with their validators (ETag and
+    Last-Modified).
+
+    Entries are keyed by the URI and the Accept and Authorization headers,
+    so each access token has its own entries. They are evicted, least
+    recently used first, once the cache grows past max_size bytes.
+    """
+
+    SUFFIX = '.rsp'
+    VALIDATORS = (('etag', 'If-None-Match'),
+                  ('last-modified', 'If-Modified-Since'))
+
+    def __init__(self, path='rk-cache', max_size=64 * 1024 * 1024):
+        super(ResponseCache, self).__init__(path, max_size)
+
+    @staticmethod
+    def token_key(headers):
+        return hashlib.sha1(headers.get('Authorization', '')).hexdigest()
+
+    def key(self, uri, headers):
+        """
+        The cache key for a GET of @uri with @headers
+        """
+
+        h = hashlib.sha1('{}\n{}'.format(uri, headers.get('Accept', '')))
+
+        return '{}-{}'.format(self.token_key(headers), h.hexdigest())
+
+    def _filename(self, uri, headers):
+        return self._path(self.key(uri, headers))
+
+    def get(self, uri, headers):
+        """
+        Returns the cached (response headers, content) or None
+        """
+
+        try:
+            with open(self._filename(uri, headers), 'rb') as fp:
+                # the headers as JSON on the first line, then the content
+                return json.loads(fp.readline()), fp.read()
+        except (IOError, ValueError):
+            return None
+
+    def touch(self, uri, headers):
+        """
+        Mark an entry as recently used
+        """
+
+        self._touch(self._filename(uri, headers))
+
+    def put(self, uri, headers, resp, content):
+        resp = dict((k, v) for k, v in resp.iteritems() if k != 'status')
+
+        def write(fp):
+            fp.write(json.dumps(resp) + '\n')
+            fp.write(content)
+
+        self._store(self._filename(uri, headers), write)
+
+    def clear(self, token=None):
+        """
+        Remove every entry, or only those for @token
+        """
+
+        prefix = ''
+
+        if token is not None:
+            prefix = self.token_key(
+                {'Authorization': 'Bearer {}'.format(token)})
+
+        super(ResponseCache, self).clear(prefix)
+
+
+class Client(object):
+    def __init__(self, pool=None, cache=None):
+        self.pool = pool or POOL
+        self.cache = cache
+
+    def request(self, uri, data={}, method='GET', headers={}, body=None,
+                use_cache=True):
+        """
+        Make a request, GETs through self.cache if there is one, unless
+        @use_cache is False
+        """
+
+        # Clients are shared between threads, don't modify the arguments
+        headers = dict(headers)
 
         if method == 'POST':
             headers['Content-Type'] = content_type = \
@@ -59,13 +367,49 @@ class Client(Http):
             if not body and content_type == 'application/x-www-form-urlencoded':
                 body = urlencode(data)
 
-        else:
-            uri = uri + '?' + urlencode(data)
+        elif data:
+            uri = uri + ('&' if '?' in uri else '?') + urlencode(data)
+
+        if method == 'GET' and use_cache and self.cache is not None:
+            return self._cached_request(uri, headers)
+
+        return self.pool.request(uri,
+                                 method=method,
+                                 headers=headers,
+                                 body=body)
+
+    def _cached_request(self, uri, headers):
+
+        # the caller wants to know if it's modified, leave it to them
+        if any(header in headers for _, header in ResponseCache.VALIDATORS):
+            return self.pool.request(uri, method='GET', headers=headers)
+
+        cached = self.cache.get(uri, headers)
+        request_headers = dict(headers)
+
+        if cached is not None:
+            cached_resp, cached_content = cached
+
+            for validator, header in ResponseCache.VALIDATORS:
+                if validator in cached_resp:
+                    request_headers[header] = cached_resp[validator]
 
-        return Http.request(self, uri,
-                            method=method,
-                            headers=headers,
-                            body=body)
+        resp, content = self.pool.request(uri, method='GET',
+                                          headers=request_headers)
+
+        if resp.status == 304 and cached is not None:
+            self.cache.touch(uri, headers)
+
+            resp = Response(dict(cached_resp, status='200'))
+            resp.fromcache = True
+
+            return resp, cached_content
+
+        if resp.status == 200 and \
+           any(validator in resp for validator, _ in ResponseCache.VALIDATORS):
+            self.cache.put(uri, headers, resp, content)
+
+        return resp, content
 
 class RK(object):
     """
@@ -83,9 +427,21 @@ class RK(object):
     AUTHORIZATION_URL = 'https://runkeeper.com/apps/authorize'
     ACCESS_TOKEN_URL = 'https://runkeeper.com/apps/token'
 
-    def __init__(self, token=None):
+    # statuses worth retrying a GET for
+    RETRY_STATUSES = ('429', '500', '502', '503', '504')
+
+    # the fitness feed's path, which is the same for every user, so that
+    # reading the feed doesn't need a request for /user first
+    FITNESS_ACTIVITIES = '/fitnessActivities'
 
-        self.client = Client()
+    def __init__(self, token=None, client=None, limiter=None,
+                 max_retries=5, backoff=1., max_backoff=60.):
+
+        self.client = client or Client()
+        self.limiter = limiter or LIMITER
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
         self.code = None
         self.token = token
         self.pages = None
@@ -174,9 +530,9 @@ class RK(object):
 
         headers.update(kwargs.pop('headers', {}))
 
-        resp, content = self.client.request(self.API_URL + path,
-                                            headers=headers,
-                                            **kwargs)
+        resp, content = self._send(self.API_URL + path,
+                                   headers=headers,
+                                   **kwargs)
 
         exceptions = {
             '304': NotModified,
@@ -195,6 +551,48 @@ class RK(object):
 
         return content
 
+    def _send(self, uri, **kwargs):
+        """
+        Make a request at the rate allowed by self.limiter.
+
+        GETs are retried after connection errors and the RETRY_STATUSES,
+        after the Retry-After the server asks for, or an exponential backoff
+        with jitter.
+        """
+
+        idempotent = kwargs.get('method', 'GET') == 'GET'
+        attempt = 0
+
+        while True:
+            self.limiter.acquire()
+
+            try:
+                resp, content = self.client.request(uri, **kwargs)
+            except (socket.error, HttpLib2Error):
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+
+                resp, content = None, None
+            else:
+                if not idempotent or attempt >= self.max_retries or \
+                   resp['status'] not in self.RETRY_STATUSES:
+                    return resp, content
+
+            delay = None
+
+            if resp is not None:
+                delay = retry_after(resp)
+
+            if delay is not None:
+                # everyone sharing the limiter is over the limit, so they
+                # all wait in acquire()
+                self.limiter.pause(delay)
+            else:
+                time.sleep(random.uniform(0, min(self.max_backoff,
+                                                 self.backoff * 2 ** attempt)))
+
+            attempt += 1
+
     def __getattr__(self, name):
         if name.startswith('get_'):
             if not self.pages:
@@ -215,29 +613,72 @@ class RK(object):
 
         return self.pages
 
-    def get_fitness_items(self):
+    def _get_fitness_pages(self, since=None):
         """
-        Yields the items from the fitness feed.
+        Yields the pages of the fitness feed, stopping after the page that
+        reaches @since.
         """
 
-        r = self.get_fitness_activities()
+        if self.pages:
+            path = self.pages['fitness_activities']
+        else:
+            path = self.FITNESS_ACTIVITIES
+
+        data = {}
+
+        if since is not None:
+            # the feed filters by date, the rest we filter ourselves
+            data['noEarlierThan'] = since.strftime('%Y-%m-%d')
+
+        r = self._request(path,
+                          accepts=self.accepts['fitness_activities'],
+                          data=data)
 
         while r:
 
-            for i in r['items']:
-                yield i
+            yield r
 
             if 'next' not in r:
                 break
 
+            if since is not None and r['items'] and \
+               parse_time(r['items'][-1]['start_time']) <= since:
+                break
+
             r = self._request(r['next'],
                               accepts=self.accepts['fitness_activities'])
 
-    def get_fitness_item(self, item, if_modified_since=None):
+    def get_fitness_items(self, since=None, prefetch_pages=0):
+        """
+        Yields the items from the fitness feed, newest first.
+
+        If @since is given, only yields the items that started after it.
+
+        If @prefetch_pages is given, up to that many pages are requested in
+        the background while the current page is being yielded.
+        """
+
+        pages = self._get_fitness_pages(since=since)
+
+        if prefetch_pages:
+            pages = prefetch(pages, prefetch_pages)
+
+        for r in pages:
+
+            for i in r['items']:
+                if since is not None and parse_time(i['start_time']) <= since:
+                    return
+
+                yield i
+
+    def get_fitness_item(self, item, if_modified_since=None, use_cache=True):
         """
         Returns a single fitness item
 
         if_modified_since assumes GMT
+
+        Pass @use_cache=False to bypass the client's cache, e.g. if the
+        caller keeps track of modifications itself.
         """
 
         if isinstance(item, basestring):
@@ -252,7 +693,7 @@ class RK(object):
                 if_modified_since.strftime('%a, %d %b %Y %H:%M:%S GMT')
 
         return self._request(path, accepts=self.accepts['fitness_activity'],
-                             headers=headers)
+                             headers=headers, use_cache=use_cache)
 
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
@@ -0,0 +1,291 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Danielle Madeley <danielle@madeley.id.au>
+
+"""
+Download many users' tracks from RunKeeper concurrently
+"""
+
+import socket
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from httplib2 import HttpLib2Error
+
+from orm import Track, db
+from rk import RK, Client, NotModified, HttpException, \
+               AuthenticationException, parse_time
+
+
+# failures talking to RunKeeper, which only cost the user or activity
+# being requested
+ERRORS = (HttpException, AuthenticationException, HttpLib2Error,
+          socket.error, ValueError)
+
+
+class SyncStats(object):
+    """
+    Thread-safe throughput statistics for a Sync.
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self.start = time.time()
+        self.end = None
+
+        self.nrequests = 0
+        self.nbytes = 0
+        self.latencies = []
+
+        self.nactivities = 0
+        self.nnot_modified = 0
+        self.nwritten = 0
+
+        # (user_id, activity uri or None for the feed, exception)
+        self.errors = []
+
+    def add_request(self, latency, nbytes):
+        with self._lock:
+            self.nrequests += 1
+            self.nbytes += nbytes
+            self.latencies.append(latency)
+
+    def add_activity(self, modified=True):
+        with self._lock:
+            self.nactivities += 1
+
+            if not modified:
+                self.nnot_modified += 1
+
+    def add_written(self, ntracks):
+        with self._lock:
+            self.nwritten += ntracks
+
+    def add_error(self, user, uri, error):
+        with self._lock:
+            self.errors.append((user.user_id, uri, error))
+
+    def finish(self):
+        self.end = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.end or time.time()) - self.start
+
+    def percentiles(self):
+        """
+        Returns the request latency (in seconds) at each of PERCENTILES
+        """
+
+        if not self.latencies:
+            return [0.] * len(self.PERCENTILES)
+
+        return np.percentile(self.latencies, self.PERCENTILES)
+
+    def report(self):
+        elapsed = self.elapsed
+
+        lines = [
+            "{} activities in {:.1f}s ({:.1f}/s), {} not modified, "
+            "{} tracks written, {} errors".format(
+                self.nactivities, elapsed,
+                self.nactivities / elapsed if elapsed else 0.,
+                self.nnot_modified, self.nwritten, len(self.errors)),
+            "{} requests, {} bytes".format(self.nrequests, self.nbytes),
+            "latency " + ', '.join(
+                "p{}={:.0f}ms".format(p, latency * 1000)
+                for p, latency in zip(self.PERCENTILES, self.percentiles())),
+        ]
+
+        lines += ["user {} {}: {!r}".format(user_id, uri or 'feed', error)
+                  for user_id, uri, error in self.errors]
+
+        return '\n'.join(lines)
+
+
+class StatsClient(Client):
+    """
+    A Client that records each request in a SyncStats
+    """
+
+    def __init__(self, stats, **kwargs):
+        super(StatsClient, self).__init__(**kwargs)
+
+        self.stats = stats
+
+    def request(self, uri, **kwargs):
+        start = time.time()
+
+        resp, content = super(StatsClient, self).request(uri, **kwargs)
+
+        self.stats.add_request(time.time() - start, len(content))
+
+        return resp, content
+
+
+class Sync(object):
+    """
+    Download users' cycling activities from RunKeeper and write them as
+    Tracks.
+
+    The users' feeds and activities are requested by a pool of @workers
+    threads, shared between users. Only the calling thread uses the
+    database, writing each user's tracks in feed order, @batch_size at a
+    time. At most @max_pending batches are downloaded ahead of being
+    written.
+
+    Feed responses are cached in @cache, an rk.ResponseCache, if given.
+
+    A user whose feed or activities fail to download is recorded in the
+    SyncStats and keeps their sync_watermark, so that the next sync tries
+    again, but doesn't stop the other users' syncs.
+    """
+
+    def __init__(self, workers=8, batch_size=25, max_pending=None,
+                 cache=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * workers
+        self.cache = cache
+
+    @staticmethod
+    def _list(job):
+        user, rk, watermark = job
+
+        try:
+            return user, rk, list(rk.get_fitness_items(since=watermark)), None
+        except ERRORS as e:
+            return user, rk, None, e
+
+    @staticmethod
+    def _fetch(job):
+        """
+        Returns the (item, json, error) of a feed item, where json is None
+        if the activity is not modified
+        """
+
+        rk, item, updated = job
+
+        # the tracks table tells us what has changed, so activities are
+        # never read back from the cache and aren't worth storing
+        try:
+            return item, rk.get_fitness_item(item, if_modified_since=updated,
+                                             use_cache=False), None
+        except NotModified:
+            return item, None, None
+        except ERRORS as e:
+            return item, None, e
+
+    def _write(self, user, result, watermark, stats, failed):
+        downloaded = []
+
+        for item, json, error in result.get():
+            if error is not None:
+                stats.add_error(user, item['uri'], error)
+                failed.add(user.id)
+                continue
+
+            stats.add_activity(modified=json is not None)
+
+            if json is None or json['equipment'] != 'None':
+                continue
+
+            downloaded.append(json)
+
+        stats.add_written(Track.upsert_rk_json(user, downloaded,
+                                               commit=False))
+
+        # everything up to the watermark is now synced, unless one of the
+        # user's activities failed
+        if watermark is not None and user.id not in failed:
+            user.sync_watermark = watermark
+
+        db.session.commit()
+
+    def sync(self, users, full=False):
+        """
+        Download the new and modified activities of @users.
+
+        Only the activities newer than each user's sync_watermark are
+        looked at, unless @full is set.
+
+        Returns the SyncStats.
+        """
+
+        stats = SyncStats()
+        pool = ThreadPool(self.workers)
+
+        # the users with a failed activity
+        failed = set()
+
+        try:
+            jobs = [(user,
+                     RK(token=user.token,
+                        client=StatsClient(stats, cache=self.cache)),
+                     None if full else user.sync_watermark)
+                    for user in users]
+
+            pending = deque()
+
+            for user, rk, items, error in pool.imap_unordered(self._list,
+                                                              jobs):
+                if error is not None:
+                    stats.add_error(user, None, error)
+                    continue
+
+                if not items:
+                    continue
+
+                # the feed is newest first
+                watermark = parse_time(items[0]['start_time'])
+                cycling = [item for item in items
+                           if item['type'] == 'Cycling']
+
+                if not cycling:
+                    user.sync_watermark = watermark
+                    db.session.commit()
+
+                for start in xrange(0, len(cycling), self.batch_size):
+                    batch = cycling[start:start + self.batch_size]
+
+                    existing = Track.get_updated(user, (item['uri']
+                                                        for item in batch))
+                    result = pool.map_async(self._fetch, [
+                        (rk, item, existing.get(item['uri']))
+                        for item in batch])
+
+                    # the watermark is only moved by the user's last batch
+                    if start + self.batch_size >= len(cycling):
+                        pending.append((user, result, watermark))
+                    else:
+                        pending.append((user, result, None))
+
+                    while len(pending) > self.max_pending:
+                        self._write(*pending.popleft(), stats=stats,
+                                    failed=failed)
+
+            while pending:
+                self._write(*pending.popleft(), stats=stats, failed=failed)
+        finally:
+            pool.terminate()
+
+        stats.finish()
+
+        return stats
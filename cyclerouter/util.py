@@ -2,6 +2,11 @@
 Utilities
 """
 
+import os
+import os.path
+import threading
+from tempfile import NamedTemporaryFile
+
 
 def monkeypatch(*args):
     """
@@ -41,3 +46,113 @@ class classproperty(property):
 
     def __get__(self, cls, owner):
         return self.fget.__get__(None, owner)()
+
+
+class CacheDirectory(object):
+    """
+    A directory of cache entries, the files ending in SUFFIX, which are
+    evicted least recently used first once they total more than max_size
+    bytes.
+
+    Subclasses map their keys to entries with _path().
+    """
+
+    SUFFIX = None
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    def _path(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    def _touch(self, path):
+        """
+        Mark an entry as recently used
+        """
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted by someone else
+            pass
+
+    def _store(self, path, write):
+        """
+        Store an entry at @path by calling @write with a file object, and
+        evict old entries.
+        """
+
+        # write to a temporary file and rename so concurrent readers never
+        # see a partial file
+        with NamedTemporaryFile(dir=self.path, suffix='.tmp',
+                                delete=False) as fp:
+            write(fp)
+
+        os.rename(fp.name, path)
+
+        self.evict()
+
+    def entries(self):
+        """
+        Returns (mtime, size, path) for each cache entry, oldest first.
+        """
+
+        entries = []
+
+        for name in os.listdir(self.path):
+            if not name.endswith(self.SUFFIX):
+                continue
+
+            path = os.path.join(self.path, name)
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                # evicted by someone else
+                continue
+
+            entries.append((st.st_mtime, st.st_size, path))
+
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until we are within
+        max_size.
+        """
+
+        with self._lock:
+            entries = self.entries()
+            size = sum(e[1] for e in entries)
+
+            for _, entry_size, path in entries:
+                if size <= self.max_size:
+                    break
+
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+                size -= entry_size
+
+    def clear(self, prefix=''):
+        """
+        Remove every entry, or only those whose keys start with @prefix
+        """
+
+        for _, _, path in self.entries():
+            if os.path.basename(path).startswith(prefix):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
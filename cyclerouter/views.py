@@ -13,18 +13,14 @@
 #
 # Authors: Danielle Madeley <danielle@madeley.id.au>
 
-SPHEROID = 'SPHEROID["WGS 84",6378137,298.257223563]'
-
 import json
 
 from flask import Flask, Response, \
                   redirect, request, url_for, stream_with_context, \
                   render_template
-from sqlalchemy import func
-
 
 from webapp import app, FlaskRK
-from orm import User, Track, pg_functions, db
+from orm import User, SiteStats
 
 
 @app.route('/')
@@ -33,14 +29,15 @@ def index():
     Pretty landing page.
     """
 
-    nusers = db.session.query(Track.user_pk).distinct().count()
+    stats = SiteStats.get()
 
-    try:
-        nkms = db.session.query(
-            func.sum(pg_functions.length_spheroid(Track.points, SPHEROID))
-        ).select_from(Track).scalar() / 1000.
-    except TypeError:
+    if stats is None:
+        # site_stats hasn't been initialised
+        nusers = 0
         nkms = 0.
+    else:
+        nusers = stats.ncontributors
+        nkms = stats.length / 1000.
 
     return render_template('index.html', **locals())
 
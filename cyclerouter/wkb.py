@@ -0,0 +1,104 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Danielle Madeley <danielle@madeley.id.au>
+
+"""
+Encoding and decoding of geometries as (E)WKB directly to and from numpy
+arrays
+"""
+
+import struct
+
+import numpy as np
+
+
+WKB_LINESTRING = 2
+
+# PostGIS EWKB type flags
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+LITTLE_ENDIAN = 1
+
+
+def encode_linestring(coords, srid=None):
+    """
+    Encode an (n, ndims) array of x, y[, z[, m]] coordinates as a little
+    endian EWKB LineString, with an SRID if given.
+
+    Three dimensional coordinates are taken as x, y, z.
+    """
+
+    coords = np.asarray(coords, dtype='<f8')
+    npoints, ndims = coords.shape
+
+    if not 2 <= ndims <= 4:
+        raise ValueError("Expected 2, 3 or 4 dimensions, not {}".format(ndims))
+
+    wkbtype = WKB_LINESTRING
+
+    if ndims >= 3:
+        wkbtype |= EWKB_Z
+    if ndims == 4:
+        wkbtype |= EWKB_M
+
+    if srid is None:
+        header = struct.pack('<BII', LITTLE_ENDIAN, wkbtype, npoints)
+    else:
+        header = struct.pack('<BIII', LITTLE_ENDIAN, wkbtype | EWKB_SRID,
+                             srid, npoints)
+
+    return header + np.ascontiguousarray(coords).tostring()
+
+
+def decode_linestring(wkb):
+    """
+    Decode a WKB or EWKB LineString into an (n, ndims) array of x, y[, z][,
+    m] coordinates. Both the PostGIS EWKB flags and the ISO type codes are
+    understood.
+
+    The array is a read-only view on @wkb, no data is copied.
+    """
+
+    order = np.frombuffer(wkb, dtype=np.uint8, count=1)[0]
+    endian = '<' if order == LITTLE_ENDIAN else '>'
+
+    wkbtype = int(np.frombuffer(wkb, dtype=endian + 'u4', count=1,
+                                offset=1)[0])
+
+    # ISO WKB encodes Z and M as 1000s, eg. 3002 is a LineString ZM
+    iso = (wkbtype & 0x0fffffff) // 1000
+
+    if (wkbtype & 0x0fffffff) % 1000 != WKB_LINESTRING:
+        raise ValueError("Not a LineString (type {:#x})".format(wkbtype))
+
+    has_z = bool(wkbtype & EWKB_Z) or iso in (1, 3)
+    has_m = bool(wkbtype & EWKB_M) or iso in (2, 3)
+
+    offset = 5
+
+    if wkbtype & EWKB_SRID:
+        offset += 4
+
+    npoints = int(np.frombuffer(wkb, dtype=endian + 'u4', count=1,
+                                offset=offset)[0])
+    offset += 4
+
+    ndims = 2 + has_z + has_m
+
+    coords = np.frombuffer(wkb, dtype=endian + 'f8', count=npoints * ndims,
+                           offset=offset)
+
+    return coords.reshape(npoints, ndims)
@@ -7,9 +7,11 @@ import numpy as np
 import scipy as sp
 import scipy.stats
 from matplotlib import pyplot as plt
+from pyproj import Proj
 
 from cyclerouter.processing.track import RKJSON, BadInputException
 from cyclerouter.processing.binning import Grid, MELBOURNE, Direction
+from tests.util import get_test_resource
 
 
 NO_PLOTS = not (os.environ.get('PLOTS', 'no') == 'yes')
@@ -46,6 +48,67 @@ def test_bin_direction():
         plt.show()
 
 
+def test_add_track_matches_per_point():
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        track = RKJSON(f)
+
+    grid = Grid([track])
+    vels = track.calculate_vels()
+
+    # rebuild the grid one point at a time, classifying each point on its
+    # own as Grid used to
+    p = Proj(proj='utm', zone=55, ellps='WGS84')
+    refx, refy = p(MELBOURNE.lon, MELBOURNE.lat)
+
+    xbins = np.digitize(vels.lon, grid.x) - 1
+    ybins = np.digitize(vels.lat, grid.y) - 1
+
+    elems_total = np.zeros_like(grid._elems_total)
+    nelems = np.zeros_like(grid._nelems)
+
+    for (x, y, vel) in zip(xbins, ybins, vels):
+        px, py = p(vel.lon, vel.lat)
+        theta = np.arctan2(refy - py, refx - px)
+        beta = (90 - np.rad2deg(theta)) % 360
+
+        if beta - 90 < vel.bearing <= beta + 90:
+            d = Direction.INBOUND
+        else:
+            d = Direction.OUTBOUND
+
+        elems_total[d, y, x] += vel.anom
+        nelems[d, y, x] += 1
+
+    # both directions are exercised
+    assert nelems[Direction.INBOUND].sum() > 0
+    assert nelems[Direction.OUTBOUND].sum() > 0
+
+    assert (grid._nelems == nelems).all()
+    assert (grid._elems_total == elems_total).all()
+
+
+def test_from_cells():
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        track = RKJSON(f)
+
+    grid = Grid([track])
+
+    cells = [(d, y, x, grid._elems_total[d, y, x], grid._nelems[d, y, x])
+             for d, y, x in zip(*grid._nelems.nonzero())]
+
+    other = Grid.from_cells(Grid.calculate_bounds([track]), cells)
+
+    assert (other.x == grid.x).all()
+    assert (other.y == grid.y).all()
+    assert (other._nelems == grid._nelems).all()
+    assert (other._elems_total == grid._elems_total).all()
+    assert (other == grid).all()
+
+
 @pytest.mark.skipif('NO_PLOTS')
 def test_binning_one():
     filename = glob('tracks/*.json')[0]
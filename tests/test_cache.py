@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pytest
+
+from cyclerouter.processing.cache import TrackCache
+from cyclerouter.processing.track import GPX, RKJSON
+from tests.util import get_test_resource
+
+
+GPX_FILES = [
+    get_test_resource('gpx', 'RK_gpx _2012-12-16_1734.gpx'),
+    get_test_resource('gpx', 'RK_gpx _2012-12-18_2012.gpx'),
+]
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return TrackCache(path=str(tmpdir))
+
+
+def test_load(cache):
+    filename = get_test_resource('json', '97684385.json')
+
+    first = cache.load(RKJSON, filename)
+    second = cache.load(RKJSON, filename)
+
+    assert isinstance(second, RKJSON)
+    assert isinstance(second.base, np.memmap)
+    assert (first == second).all()
+    assert len(cache.entries()) == 1
+
+
+def test_version_invalidates(cache, monkeypatch):
+    cache.load(GPX, GPX_FILES[0])
+
+    monkeypatch.setattr(GPX, 'VERSION', GPX.VERSION + 1)
+
+    cache.load(GPX, GPX_FILES[0])
+
+    assert len(cache.entries()) == 2
+
+
+def test_evict(cache):
+    cache.load(GPX, GPX_FILES[0])
+    size = cache.entries()[0][1]
+
+    cache.max_size = size
+    # make sure the first entry is the least recently used
+    os.utime(cache.entries()[0][2], (0, 0))
+    cache.load(GPX, GPX_FILES[1])
+
+    entries = cache.entries()
+
+    assert len(entries) == 1
+    assert entries[0][2].endswith(cache.key(GPX, GPX_FILES[1]) + '.npy')
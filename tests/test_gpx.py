@@ -2,12 +2,13 @@ from math import *
 import os
 import os.path
 
+import numpy as np
 import pytest
 
 from matplotlib import pyplot as plt
 from mpl_toolkits.basemap import Basemap
 
-from cyclerouter.processing.track import GPX, smooth
+from cyclerouter.processing.track import GPX, smooth, _split_utc_offset
 
 
 NO_PLOTS = not (os.environ.get('PLOTS', 'no') == 'yes')
@@ -33,6 +34,75 @@ def test_import(xml):
     assert track is not None
 
 
+def test_import_limit(xml):
+    track = GPX(xml, limit=100)
+
+    assert len(track) == 100
+
+
+def test_import_chunksize(xml):
+    track = GPX(xml, chunksize=7)
+
+    xml.seek(0)
+    assert (track == GPX(xml)).all()
+
+
+@pytest.mark.parametrize(('timestamp', 'expected'), [
+    ('2012-12-16T15:34:11Z', '2012-12-16T15:34:11'),
+    ('2012-12-16T15:34:11.250Z', '2012-12-16T15:34:11.250'),
+    ('2012-12-17T01:34:11+10:00', '2012-12-16T15:34:11'),
+    ('2012-12-16T10:04:11-05:30', '2012-12-16T15:34:11'),
+    ('2012-12-16T15:34:11', '2012-12-16T15:34:11'),
+])
+def test_split_utc_offset(timestamp, expected):
+    local, offset = _split_utc_offset(timestamp)
+
+    utc = np.datetime64(local, 'ms') - np.timedelta64(offset, 'm')
+
+    assert utc == np.datetime64(expected, 'ms')
+
+
+@pytest.mark.parametrize('window', ['flat', 'hanning'])
+@pytest.mark.parametrize('window_len', [3, 11, 64, 65, 1000])
+def test_smooth_matches_convolve(window, window_len):
+    x = np.random.RandomState(0).rand(5000) * 40
+
+    # reference reflection-padded direct convolution
+    s = np.r_[x[window_len - 1:0:-1], x, x[-1:-window_len:-1]]
+    if window == 'flat':
+        w = np.ones(window_len, 'd')
+    else:
+        w = getattr(np, window)(window_len)
+    y = np.convolve(w / w.sum(), s, mode='valid')
+    expected = y[window_len / 2 - 1:-window_len / 2]
+
+    actual = smooth(x, window_len=window_len, window=window)
+
+    assert actual.shape == x.shape
+    assert np.allclose(actual, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_time_is_datetime64(xml):
+    track = GPX(xml)
+
+    assert track.time.dtype == np.dtype('datetime64[ms]')
+    assert (np.diff(track.time) >= np.timedelta64(0)).all()
+
+
+def test_vels_multiday_gap(xml):
+    track = GPX(xml)
+
+    # pause the ride overnight halfway through
+    n = len(track) / 2
+    track.time[n:] += np.timedelta64(1, 'D')
+
+    vels = track.calculate_vels()
+    gap = vels.vel[vels.time == track.time[n]]
+
+    assert len(gap) == 1
+    assert gap[0] < 1 # km/h
+
+
 @pytest.mark.skipif('NO_PLOTS')
 def test_plot_elevation(xml):
     track = GPX(xml)
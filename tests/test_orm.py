@@ -1,8 +1,11 @@
 import json
+from datetime import datetime
 
 import numpy as np
 
-from cyclerouter.orm import User, Track
+from cyclerouter.orm import User, Track, SiteStats
+from cyclerouter.rk import parse_time
+from cyclerouter.processing.track import RKJSON
 from tests.util import get_test_resource
 
 
@@ -143,3 +146,345 @@ def test_cascade(db):
 
     assert User.query.count() == 2
     assert Track.query.count() == 0
+
+
+def test_bulk_import_track(db):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    # test_cascade removed our user
+    db.session.add(User(user_id=data['userID']))
+    db.session.commit()
+
+    assert Track.bulk_from_rk_json([data, data]) == 1
+
+    assert Track.query.count() == 1
+
+    track = Track.get_track(data['userID'], data['uri'])
+    updated = track.updated
+
+    npoints = db.session.scalar(track.points.num_points())
+
+    assert len(data['path']) == npoints
+
+    length = db.session.scalar(track.points.transform(32755).length())
+
+    assert np.abs(data['total_distance'] - length) < 10 # within 10m
+
+    # reimport updates the existing track
+    assert Track.bulk_from_rk_json([data]) == 1
+
+    assert Track.query.count() == 1
+    assert Track.get_track(data['userID'], data['uri']).updated > updated
+
+
+def test_upsert_track(db):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    user = User.get_user(data['userID'])
+    existing = Track.get_updated(user, [data['uri'], '/fitnessActivities/0'])
+
+    assert existing.keys() == [data['uri']]
+
+    assert Track.upsert_rk_json(user, [data, data]) == 1
+
+    assert Track.query.count() == 1
+    assert Track.get_updated(data['userID'], [data['uri']])[data['uri']] > \
+        existing[data['uri']]
+
+    other = dict(data, uri='/fitnessActivities/1')
+
+    assert Track.upsert_rk_json(data['userID'], [other]) == 1
+
+    assert Track.query.count() == 2
+    assert len(user.tracks) == 2
+
+
+def test_site_stats(db):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    stats = SiteStats.get()
+
+    # test_upsert_track left two copies of the track for one user
+    assert stats.ncontributors == 1
+    assert np.abs(2 * data['total_distance'] - stats.length) < 20
+
+    track = Track.get_track(data['userID'], data['uri'])
+
+    assert np.abs(data['total_distance'] - track.length) < 10 # within 10m
+    assert track.minlon == min(p['longitude'] for p in data['path'])
+    assert track.maxlat == max(p['latitude'] for p in data['path'])
+
+    length = stats.length
+    SiteStats.recalculate()
+    assert np.abs(SiteStats.get().length - length) < 1e-6
+
+    db.session.delete(track.user)
+    db.session.commit()
+
+    stats = SiteStats.get()
+
+    assert Track.query.count() == 0
+    assert stats.ncontributors == 0
+    assert np.abs(stats.length) < 1e-6
+
+
+def test_site_stats_batch(db):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    user = User(user_id=data['userID'])
+    db.session.add(user)
+    db.session.commit()
+
+    # both of a new user's tracks are written by one statement
+    other = dict(data, uri='/fitnessActivities/1')
+    Track.upsert_rk_json(user, [data, other])
+
+    stats = SiteStats.get()
+
+    assert stats.ncontributors == 1
+    assert np.abs(2 * data['total_distance'] - stats.length) < 20
+
+    db.session.delete(user)
+    db.session.commit()
+
+    stats = SiteStats.get()
+
+    assert stats.ncontributors == 0
+    assert np.abs(stats.length) < 1e-6
+
+
+def test_query_tracks(db):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    user = User(user_id=data['userID'])
+    db.session.add(user)
+    db.session.commit()
+
+    Track.upsert_rk_json(user, [data])
+
+    lons = [p['longitude'] for p in data['path']]
+    lats = [p['latitude'] for p in data['path']]
+    bbox = (min(lons), min(lats), max(lons), max(lats))
+
+    def track_ids(**kwargs):
+        return [t.track_id for t in Track.query_tracks(**kwargs)]
+
+    assert track_ids() == [data['uri']]
+    assert track_ids(bbox=bbox, user=user) == [data['uri']]
+    assert track_ids(bbox=(0, 0, 1, 1)) == []
+    assert track_ids(start=datetime(2012, 1, 1),
+                     end=datetime(2013, 1, 1)) == [data['uri']]
+    assert track_ids(start=datetime(2013, 1, 1)) == []
+
+    tracks = Track.load_tracks(Track.query_tracks(bbox=bbox))
+
+    with open(filename) as f:
+        expected = RKJSON(f)
+
+    assert tracks.ntracks == 1
+
+    for name in expected.dtype.names:
+        assert (tracks.track(0)[name] == expected[name]).all()
+
+    db.session.delete(user)
+    db.session.commit()
+
+
+def test_aggregate_grid(db):
+    from cyclerouter.processing.binning import Grid
+
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    # a second track too short to smooth
+    short = dict(data, uri=data['uri'] + '-short', path=data['path'][:8])
+
+    user = User(user_id=data['userID'])
+    db.session.add(user)
+    db.session.commit()
+
+    Track.upsert_rk_json(user, [data, short])
+
+    tracks = Track.load_tracks()
+    expected = Grid([tracks.track(i) for i in range(tracks.ntracks)],
+                    xnum=20, ynum=20)
+
+    grid = Track.aggregate_grid(xnum=20, ynum=20)
+
+    assert (grid.x == expected.x).all()
+    assert (grid.y == expected.y).all()
+    assert (grid._nelems == expected._nelems).all()
+    assert np.allclose(grid._elems_total, expected._elems_total)
+    assert np.allclose(grid, expected)
+
+    db.session.delete(user)
+    db.session.commit()
+
+
+def test_simplified_tracks(db):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    user = User(user_id=data['userID'])
+    db.session.add(user)
+    db.session.commit()
+
+    Track.upsert_rk_json(user, [data])
+
+    assert Track.points_at() is Track.points
+    assert Track.points_at(0.00005) is Track.points
+    assert Track.points_at(0.0005) is Track.points_medium
+    assert Track.points_at(0.01) is Track.points_low
+
+    full = Track.load_tracks()
+    medium = Track.load_tracks(resolution=0.0005)
+    low = Track.load_tracks(resolution=0.01)
+
+    assert len(full) > len(medium) > len(low) >= 2
+
+    # simplification only ever drops points
+    assert np.in1d(low.time, full.time).all()
+    assert low.time[0] == full.time[0]
+    assert low.time[-1] == full.time[-1]
+
+    db.session.delete(user)
+    db.session.commit()
+
+
+def check_date_change(db, data):
+    """
+    Upserts and bulk loads move a track whose date has changed
+    """
+
+    def dates():
+        return [date for date, in db.session.query(Track.date).filter(
+            Track.track_id == data['uri'])]
+
+    date = parse_time(data['start_time'])
+    moved = dict(data, start_time='Tue, 1 Jan 2013 06:00:00')
+
+    assert Track.upsert_rk_json(data['userID'], [moved]) == 1
+    assert dates() == [datetime(2013, 1, 1, 6)]
+
+    assert Track.bulk_from_rk_json([data]) == 1
+    assert dates() == [date]
+
+    assert Track.query.count() == 1
+
+
+def test_upsert_track_date(db):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    user = User(user_id=data['userID'])
+    db.session.add(user)
+    db.session.commit()
+
+    Track.upsert_rk_json(user, [data])
+
+    check_date_change(db, data)
+
+    db.session.delete(user)
+    db.session.commit()
+
+    assert Track.query.count() == 0
+
+
+def test_partition(db):
+    # this leaves the tracks table partitioned for any later tests
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    user = User(user_id=data['userID'])
+    db.session.add(user)
+    db.session.commit()
+
+    Track.upsert_rk_json(user, [data])
+    length = SiteStats.get().length
+
+    Track.partition('year')
+
+    def partitions():
+        return [name for name, in db.session.execute(
+            'SELECT tableoid::regclass::text FROM tracks')]
+
+    assert partitions() == ['tracks_y2012']
+    assert SiteStats.get().length == length
+
+    # upserts still update in place
+    Track.upsert_rk_json(user, [data])
+    assert partitions() == ['tracks_y2012']
+
+    # or move tracks between partitions
+    check_date_change(db, data)
+    assert partitions() == ['tracks_y2012']
+
+    # new tracks are routed to their partition, or the default one
+    Track.create_partitions(datetime(2013, 1, 1), datetime(2013, 1, 1),
+                            interval='year')
+    later = dict(data, uri=data['uri'] + '-later',
+                 start_time='Tue, 1 Jan 2013 06:00:00')
+    latest = dict(data, uri=data['uri'] + '-latest',
+                  start_time='Wed, 1 Jan 2014 06:00:00')
+    Track.upsert_rk_json(user, [later, latest])
+
+    assert sorted(partitions()) == \
+        ['tracks_default', 'tracks_y2012', 'tracks_y2013']
+    assert [t.track_id for t in Track.query_tracks(
+        start=datetime(2013, 1, 1), end=datetime(2014, 1, 1))] == \
+        [later['uri']]
+
+    # tracks already in the default partition are moved to a new one
+    length = SiteStats.get().length
+    Track.create_partitions(datetime(2014, 1, 1), datetime(2014, 1, 1),
+                            interval='year')
+
+    assert sorted(partitions()) == \
+        ['tracks_y2012', 'tracks_y2013', 'tracks_y2014']
+    assert [t.track_id for t in Track.query_tracks(
+        start=datetime(2014, 1, 1))] == [latest['uri']]
+    assert SiteStats.get().length == length
+
+    db.session.delete(user)
+    db.session.commit()
+
+    assert Track.query.count() == 0
+
+
+def test_partition_ranges():
+    from cyclerouter.orm import partition_ranges
+
+    assert list(partition_ranges(datetime(2012, 11, 5),
+                                 datetime(2013, 1, 1), 'month')) == [
+        ('tracks_m2012_11', datetime(2012, 11, 1), datetime(2012, 12, 1)),
+        ('tracks_m2012_12', datetime(2012, 12, 1), datetime(2013, 1, 1)),
+        ('tracks_m2013_01', datetime(2013, 1, 1), datetime(2013, 2, 1)),
+    ]
+    assert list(partition_ranges(datetime(2012, 11, 5),
+                                 datetime(2013, 1, 1), 'year')) == [
+        ('tracks_y2012', datetime(2012, 1, 1), datetime(2013, 1, 1)),
+        ('tracks_y2013', datetime(2013, 1, 1), datetime(2014, 1, 1)),
+    ]
@@ -1,7 +1,18 @@
+import hashlib
+import json
 import os
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from datetime import datetime
+from urlparse import urlparse, parse_qs
+
 import pytest
 
-from cyclerouter.rk import CommandLineClient as RK
+from cyclerouter.rk import CommandLineClient as RK, Client, ConnectionPool, \
+                           FileNotFound, NotModified, ResponseCache, \
+                           HttpException, RateLimiter, retry_after
 
 
 NO_NET = not (os.environ.get('NET', 'no') == 'yes')
@@ -63,3 +74,362 @@ def test_get_fitness_item(rk):
     print item
 
     assert item
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.paths.append(self.path)
+            server.requests.append(dict(self.headers))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+
+        time.sleep(server.delay)
+
+        with server.lock:
+            server.active -= 1
+
+            failure = server.failures.pop(0) if server.failures else None
+
+        if failure is not None:
+            status, headers = failure
+
+            self.send_response(status)
+            for header in headers.iteritems():
+                self.send_header(*header)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = json.dumps(server.pages.get(urlparse(self.path).path,
+                                           {'path': self.path}))
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+        # pretend nothing is ever modified since
+        if self.headers.get('If-None-Match') == etag or \
+           'If-Modified-Since' in self.headers:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server(request):
+    server = CountingServer(('localhost', 0), CountingHandler)
+    server.lock = threading.Lock()
+    server.connections = set()
+    server.paths = []
+    server.requests = []
+    server.failures = []
+    server.pages = {}
+    server.active = server.max_active = 0
+    server.delay = 0
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    request.addfinalizer(server.shutdown)
+
+    server.url = 'http://localhost:{}/'.format(server.server_port)
+
+    return server
+
+
+def test_pool_keep_alive(server):
+    pool = ConnectionPool()
+
+    for i in range(10):
+        resp, content = Client(pool=pool).request(server.url + str(i))
+
+        assert resp.status == 200
+        assert json.loads(content)['path'] == '/{}'.format(i)
+
+    # every request reused the same connection
+    assert len(server.connections) == 1
+
+
+def test_pool_per_host_limit(server):
+    pool = ConnectionPool(max_per_host=4)
+    pool.set_limit(server.url, 2)
+    client = Client(pool=pool)
+
+    server.delay = 0.05
+
+    threads = [threading.Thread(target=client.request, args=(server.url,))
+               for i in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert server.max_active == 2
+    assert len(server.connections) == 2
+
+
+def test_get_fitness_items_since(server):
+    server.pages = {
+        '/user': {'fitness_activities': '/fitnessActivities'},
+        '/fitnessActivities': {
+            'items': [{'uri': '/fitnessActivities/3',
+                       'start_time': 'Thu, 3 Jan 2013 06:00:00'},
+                      {'uri': '/fitnessActivities/2',
+                       'start_time': 'Wed, 2 Jan 2013 06:00:00'}],
+            'next': '/fitnessActivities/page2?page=1',
+        },
+        '/fitnessActivities/page2': {
+            'items': [{'uri': '/fitnessActivities/1',
+                       'start_time': 'Tue, 1 Jan 2013 06:00:00'}],
+        },
+    }
+
+    rk = RK(token='TOKEN', client=Client(pool=ConnectionPool()))
+    rk.API_URL = server.url.rstrip('/')
+
+    uris = [item['uri'] for item in rk.get_fitness_items()]
+
+    assert uris == ['/fitnessActivities/3',
+                    '/fitnessActivities/2',
+                    '/fitnessActivities/1']
+    assert server.paths[-1] == '/fitnessActivities/page2?page=1'
+
+    del server.paths[:]
+
+    # a new RK, as each sync makes, doesn't need to ask for /user
+    rk = RK(token='TOKEN', client=Client(pool=ConnectionPool()))
+    rk.API_URL = server.url.rstrip('/')
+
+    uris = [item['uri'] for item in
+            rk.get_fitness_items(since=datetime(2013, 1, 2, 6))]
+
+    assert uris == ['/fitnessActivities/3']
+
+    # the feed was filtered, and not paged past the watermark
+    assert len(server.paths) == 1
+    assert parse_qs(urlparse(server.paths[0]).query) == \
+        {'noEarlierThan': ['2013-01-02']}
+
+
+def test_get_fitness_items_prefetch(server):
+    npages = 5
+
+    for page in range(npages):
+        path = '/fitnessActivities/{}'.format(page)
+        server.pages[path] = {
+            'items': [{'uri': '/fitnessActivities/{}'.format(10 * page + i),
+                       'start_time': 'Tue, 1 Jan 2013 06:00:00'}
+                      for i in range(10)],
+        }
+
+        if page < npages - 1:
+            server.pages[path]['next'] = \
+                '/fitnessActivities/{}'.format(page + 1)
+
+    server.pages['/user'] = {'fitness_activities': '/fitnessActivities/0'}
+
+    rk = RK(token='TOKEN', client=Client(pool=ConnectionPool()))
+    rk.API_URL = server.url.rstrip('/')
+
+    # the feed is wherever /user says, once it has been asked
+    rk.get_user()
+
+    expected = list(rk.get_fitness_items())
+
+    assert len(expected) == 10 * npages
+    assert list(rk.get_fitness_items(prefetch_pages=2)) == expected
+
+    # the background requests stop when the caller does
+    server.delay = 0.05
+    del server.paths[:]
+
+    items = rk.get_fitness_items(prefetch_pages=1)
+    assert items.next() == expected[0]
+    items.close()
+
+    time.sleep(0.5)
+
+    # at most the page in hand, the queued one and the one being put
+    assert len(server.paths) <= 3
+
+
+def test_prefetch_raises():
+    from cyclerouter.rk import prefetch
+
+    def pages():
+        yield 1
+        yield 2
+        raise FileNotFound(None)
+
+    items = prefetch(pages(), 1)
+
+    assert items.next() == 1
+    assert items.next() == 2
+
+    with pytest.raises(FileNotFound):
+        items.next()
+
+
+def test_response_cache(server, tmpdir):
+    cache = ResponseCache(path=str(tmpdir))
+    client = Client(pool=ConnectionPool(), cache=cache)
+
+    server.pages['/user'] = {'userID': 1}
+
+    def get(token, **headers):
+        headers['Authorization'] = 'Bearer {}'.format(token)
+
+        return client.request(server.url + 'user', headers=headers)
+
+    resp, content = get('A')
+    assert resp.status == 200
+    assert not resp.fromcache
+    assert len(cache.entries()) == 1
+
+    # revalidated, and served from the cache
+    resp, content = get('A')
+    assert resp.status == 200
+    assert resp['status'] == '200'
+    assert resp.fromcache
+    assert json.loads(content) == {'userID': 1}
+    assert server.requests[-1]['if-none-match'] == resp['etag']
+
+    # modified
+    server.pages['/user'] = {'userID': 2}
+    resp, content = get('A')
+    assert not resp.fromcache
+    assert json.loads(content) == {'userID': 2}
+
+    # each token has its own entries
+    resp, content = get('B')
+    assert 'if-none-match' not in server.requests[-1]
+    assert len(cache.entries()) == 2
+
+    # the caller's own conditional requests are left to the caller
+    resp, content = get('B', **{'If-None-Match': resp['etag']})
+    assert resp.status == 304
+
+    cache.clear(token='B')
+    assert len(cache.entries()) == 1
+
+
+def test_response_cache_evict(server, tmpdir):
+    cache = ResponseCache(path=str(tmpdir), max_size=1024)
+    client = Client(pool=ConnectionPool(), cache=cache)
+
+    for i in range(20):
+        server.pages['/{}'.format(i)] = {'data': 'x' * 100}
+        client.request(server.url + str(i))
+
+        # the least recently used is evicted
+        time.sleep(0.01)
+        client.request(server.url + '0')
+
+    assert sum(size for _, size, _ in cache.entries()) <= 1024
+    assert client.request(server.url + '0')[0].fromcache
+    assert not client.request(server.url + '1')[0].fromcache
+
+
+def test_rk_cached(server, tmpdir):
+    server.pages['/user'] = {'fitness_activities': '/fitnessActivities'}
+
+    cache = ResponseCache(path=str(tmpdir))
+    rk = RK(token='TOKEN',
+            client=Client(pool=ConnectionPool(), cache=cache))
+    rk.API_URL = server.url.rstrip('/')
+
+    assert rk.get_user() == server.pages['/user']
+    assert rk.get_user() == server.pages['/user']
+
+    # NotModified is only raised for the caller's conditional requests
+    with pytest.raises(NotModified):
+        rk.get_fitness_item('/user', if_modified_since=datetime.utcnow())
+
+    # and responses can bypass the cache
+    cache.clear()
+    assert rk.get_fitness_item('/user', use_cache=False) == \
+        server.pages['/user']
+    assert cache.entries() == []
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=50, burst=5)
+
+    start = time.time()
+
+    # the burst is allowed straight away
+    for i in range(5):
+        limiter.acquire()
+
+    assert time.time() - start < 0.05
+
+    for i in range(10):
+        limiter.acquire()
+
+    assert time.time() - start >= 0.18
+
+    limiter = RateLimiter()
+    limiter.pause(0.2)
+
+    start = time.time()
+    limiter.acquire()
+
+    assert time.time() - start >= 0.18
+
+
+def test_retry_after():
+    assert retry_after({}) is None
+    assert retry_after({'retry-after': '120'}) == 120
+    assert retry_after({'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 0
+    assert retry_after({'retry-after': 'soon'}) is None
+
+    later = time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                          time.gmtime(time.time() + 60))
+    assert 55 < retry_after({'retry-after': later}) <= 60
+
+
+def test_request_retries(server):
+    server.pages['/user'] = {'userID': 1}
+
+    rk = RK(token='TOKEN', client=Client(pool=ConnectionPool()),
+            limiter=RateLimiter(), max_retries=3, backoff=0.01)
+    rk.API_URL = server.url.rstrip('/')
+
+    server.failures = [(503, {}), (502, {}), (429, {'Retry-After': '1'})]
+
+    start = time.time()
+
+    assert rk.get_user() == {'userID': 1}
+    assert len(server.paths) == 4
+
+    # the Retry-After was honoured
+    assert time.time() - start >= 1
+
+    # until we run out of retries
+    server.failures = [(503, {})] * 4
+
+    with pytest.raises(HttpException):
+        rk.get_user()
+
+    assert len(server.paths) == 8
+    assert not server.failures
@@ -5,7 +5,9 @@ import pytest
 from matplotlib import pyplot as plt
 from numpy.testing import assert_almost_equal, assert_allclose
 
-from cyclerouter.processing.srtm import SRTM
+from cyclerouter.processing.srtm import SRTM, SRTMMosaic, MappedSRTM, \
+                                        OutOfBounds, convert_grid, \
+                                        DEFAULT_GRIDFILE
 
 from tests.test_json import json as track_json
 
@@ -18,6 +20,10 @@ NO_NET = not (os.environ.get('NET', 'no') == 'yes')
 def grid():
     return SRTM()
 
+@pytest.fixture(scope='module')
+def lazy_grid():
+    return SRTM(lazy=True)
+
 @pytest.fixture
 def track(track_json):
     from cyclerouter.processing.track import RKJSON
@@ -53,6 +59,127 @@ def test_load_srtm(grid):
            grid.lons[0] <= 144.960 <= grid.lons[-1]
 
 
+def test_extract_points(grid):
+    lats = [-37.81361, -37.868, -37.767]
+    lons = [144.96306, 144.83, 144.960]
+
+    elevs = grid.extract_points(lats, lons)
+
+    assert elevs.shape == (3,)
+
+    for elev, lat, lon in zip(elevs, lats, lons):
+        assert elev == grid.extract_point(lat, lon)
+
+
+def test_extract_points_out_of_bounds(grid):
+    lats = [-37.81361, grid.lats[0] + 1, -37.767]
+    lons = [144.96306, 144.83, grid.lons[-1] + 1]
+
+    with pytest.raises(OutOfBounds):
+        grid.extract_point(lats[1], lons[1])
+
+    elevs = grid.extract_points(lats, lons)
+
+    assert list(elevs.mask) == [False, True, True]
+
+
+def test_extract_points_bilinear(grid):
+    # Brunswick
+    r, c = grid._lookup(-37.767, 144.960)[:2]
+
+    # at the grid points bilinear is the same as nearest
+    lats = grid.lats[[r, r + 1]]
+    lons = grid.lons[[c, c + 1]]
+    assert_allclose(grid.extract_points(lats, lons, method='bilinear'),
+                    grid.extract_points(lats, lons))
+
+    # halfway between two columns is their mean
+    elev = grid.extract_points([grid.lats[r]],
+                               [grid.lons[c] + grid.binsize / 2],
+                               method='bilinear')
+    assert_allclose(elev, (float(grid[r, c]) + grid[r, c + 1]) / 2)
+
+    elevs = grid.extract_points([grid.lats[0] + 1], [144.960],
+                                method='bilinear')
+    assert elevs.mask.all()
+
+
+def test_lazy_srtm(grid, lazy_grid):
+    assert lazy_grid.shape == grid.shape
+    assert_almost_equal(lazy_grid.binsize, grid.binsize)
+    assert (lazy_grid.lats == grid.lats).all()
+    assert (lazy_grid.lons == grid.lons).all()
+
+    lats = [-37.81361, -37.868, -37.767, grid.lats[0] + 1]
+    lons = [144.96306, 144.83, 144.960, 144.83]
+
+    expected = grid.extract_points(lats, lons)
+    actual = lazy_grid.extract_points(lats, lons)
+
+    assert (actual.mask == expected.mask).all()
+    assert (actual.filled(0) == expected.filled(0)).all()
+
+    assert (lazy_grid[:100, 0].filled(0) == grid[:100, 0].filled(0)).all()
+    assert len(lazy_grid.blocks) <= lazy_grid.max_blocks
+
+
+def test_mapped_srtm(grid, tmpdir):
+    rawfile = str(tmpdir.join('dem3s_int.raw'))
+    convert_grid(DEFAULT_GRIDFILE, rawfile)
+
+    mapped = SRTM(rawfile, mmap=True)
+
+    assert mapped.shape == grid.shape
+    assert (mapped.lats == grid.lats).all()
+    assert (mapped.lons == grid.lons).all()
+
+    lats = [-37.81361, -37.868, -37.767, grid.lats[0] + 1]
+    lons = [144.96306, 144.83, 144.960, 144.83]
+
+    expected = grid.extract_points(lats, lons)
+    actual = mapped.extract_points(lats, lons)
+
+    assert (actual.mask == expected.mask).all()
+    assert (actual.filled(0) == expected.filled(0)).all()
+
+
+def test_mosaic(grid):
+    mosaic = SRTMMosaic([DEFAULT_GRIDFILE])
+
+    lats = [-37.81361, -37.868, -37.767, grid.lats[0] + 1]
+    lons = [144.96306, 144.83, 144.960, 144.83]
+
+    expected = grid.extract_points(lats, lons)
+    actual = mosaic.extract_points(lats, lons)
+
+    assert (actual.mask == expected.mask).all()
+    assert (actual.filled(0) == expected.filled(0)).all()
+
+    assert mosaic.extract_point(lats[0], lons[0]) == expected[0]
+
+    with pytest.raises(OutOfBounds):
+        mosaic.extract_point(lats[3], lons[3])
+
+
+def test_mosaic_mapped(grid, tmpdir):
+    rawfile = str(tmpdir.join('dem3s_int.raw'))
+    convert_grid(DEFAULT_GRIDFILE, rawfile)
+
+    lats = [-37.81361, -37.868, -37.767, grid.lats[0] + 1]
+    lons = [144.96306, 144.83, 144.960, 144.83]
+
+    expected = grid.extract_points(lats, lons)
+
+    # raw tiles are memory-mapped, others opened with GDAL
+    for tiles in ([rawfile], [rawfile, DEFAULT_GRIDFILE]):
+        mosaic = SRTMMosaic(tiles)
+        actual = mosaic.extract_points(lats, lons)
+
+        assert isinstance(mosaic.tile(0), MappedSRTM)
+        assert (actual.mask == expected.mask).all()
+        assert (actual.filled(0) == expected.filled(0)).all()
+
+
 @pytest.mark.skipif('NO_PLOTS')
 def test_plot_srtm(grid):
 
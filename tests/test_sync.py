@@ -0,0 +1,162 @@
+import json
+from datetime import datetime
+
+import numpy as np
+from httplib2 import Response
+
+from cyclerouter.orm import User, Track
+from cyclerouter.rk import NotModified, FileNotFound, PermissionDenied, \
+                           parse_time
+from cyclerouter.sync import Sync, SyncStats
+from tests.util import get_test_resource
+
+
+def test_stats_report():
+    stats = SyncStats()
+
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        stats.add_request(latency, 1000)
+        stats.add_activity()
+
+    stats.add_activity(modified=False)
+    stats.add_written(4)
+    stats.add_error(User(user_id=7), '/fitnessActivities/1',
+                    FileNotFound(Response({'status': '404'})))
+    stats.finish()
+
+    assert stats.nbytes == 4000
+    assert stats.nactivities == 5
+    assert np.allclose(stats.percentiles(), [0.25, 0.37, 0.397])
+
+    report = stats.report()
+
+    assert '5 activities' in report
+    assert '1 not modified' in report
+    assert '4 tracks written' in report
+    assert '1 errors' in report
+    assert 'user 7 /fitnessActivities/1: FileNotFound (404)' in report
+    assert '4000 bytes' in report
+    assert 'p50=250ms' in report
+
+
+def test_sync(db, monkeypatch):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    requested = []
+
+    class FakeRK(object):
+        def __init__(self, token=None, client=None):
+            self.token = token
+
+        def get_fitness_items(self, since=None):
+            items = [{'type': 'Running', 'uri': '/fitnessActivities/1',
+                      'start_time': 'Mon, 31 Dec 2012 06:00:00'}]
+            items += [{'type': 'Cycling',
+                       'uri': '{}-{}'.format(data['uri'], i),
+                       'start_time': 'Mon, {} Dec 2012 06:00:00'.format(
+                           20 - i)}
+                      for i in range(10)]
+
+            # newest first
+            for item in sorted(items, key=lambda item: parse_time(
+                    item['start_time']), reverse=True):
+                if since is None or parse_time(item['start_time']) > since:
+                    yield item
+
+        def get_fitness_item(self, item, if_modified_since=None,
+                             use_cache=True):
+            requested.append((self.token, item['uri']))
+
+            if if_modified_since is not None:
+                raise NotModified(None)
+
+            return dict(data, uri=item['uri'])
+
+    monkeypatch.setattr('cyclerouter.sync.RK', FakeRK)
+
+    # user_ids that test_orm doesn't create
+    users = [User(user_id=1000 + i, token=str(i)) for i in range(3)]
+    db.session.add_all(users)
+    db.session.commit()
+
+    stats = Sync(workers=4, batch_size=3, max_pending=2).sync(users)
+
+    assert stats.nactivities == 30
+    assert stats.nwritten == 30
+    assert Track.query.count() == 30
+    assert len(requested) == 30
+
+    for user in users:
+        assert user.sync_watermark == datetime(2012, 12, 31, 6)
+
+    # nothing new since the watermark
+    stats = Sync(workers=4, batch_size=3).sync(users)
+
+    assert stats.nactivities == 0
+    assert len(requested) == 30
+
+    # everything is there now
+    stats = Sync(workers=4, batch_size=3).sync(users, full=True)
+
+    assert stats.nactivities == 30
+    assert stats.nnot_modified == 30
+    assert stats.nwritten == 0
+
+    for user in users:
+        db.session.delete(user)
+    db.session.commit()
+
+
+def test_sync_errors(db, monkeypatch):
+    filename = get_test_resource('json/97684385.json')
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    class FakeRK(object):
+        def __init__(self, token=None, client=None):
+            self.token = token
+
+        def get_fitness_items(self, since=None):
+            if self.token == '1':
+                raise PermissionDenied(Response({'status': '403'}))
+
+            for i in range(3):
+                yield {'type': 'Cycling',
+                       'uri': '{}-{}'.format(data['uri'], i),
+                       'start_time': 'Mon, {} Dec 2012 06:00:00'.format(
+                           20 - i)}
+
+        def get_fitness_item(self, item, if_modified_since=None,
+                             use_cache=True):
+            if self.token == '2' and item['uri'].endswith('-1'):
+                raise FileNotFound(Response({'status': '404'}))
+
+            return dict(data, uri=item['uri'])
+
+    monkeypatch.setattr('cyclerouter.sync.RK', FakeRK)
+
+    # user_ids that test_orm doesn't create
+    users = [User(user_id=1000 + i, token=str(i)) for i in range(3)]
+    db.session.add_all(users)
+    db.session.commit()
+
+    stats = Sync(workers=4, batch_size=2).sync(users)
+
+    # the other users' tracks are still written
+    assert sorted((user_id, uri) for user_id, uri, _ in stats.errors) == \
+        [(1001, None), (1002, data['uri'] + '-1')]
+    assert stats.nwritten == 5
+    assert Track.query.count() == 5
+
+    # only the user without errors is synced up to their watermark
+    assert users[0].sync_watermark == datetime(2012, 12, 20, 6)
+    assert users[1].sync_watermark is None
+    assert users[2].sync_watermark is None
+
+    for user in users:
+        db.session.delete(user)
+    db.session.commit()
@@ -0,0 +1,62 @@
+from glob import glob
+
+import numpy as np
+import pytest
+
+from cyclerouter.processing.track import GPX, RKJSON, Tracks, smooth, \
+                                         smooth_segments
+from tests.util import get_test_resource
+
+
+@pytest.fixture(scope='module')
+def tracks():
+    tracks = []
+
+    for filename in sorted(glob(get_test_resource('gpx', '*.gpx'))):
+        with open(filename, 'rb') as fp:
+            tracks.append(GPX(fp))
+
+    with open(get_test_resource('json', '97684385.json')) as fp:
+        tracks.append(RKJSON(fp))
+
+    return tracks
+
+
+def test_offsets(tracks):
+    collection = Tracks(tracks)
+
+    assert collection.ntracks == len(tracks)
+    assert len(collection) == sum(len(t) for t in tracks)
+
+    for i, track in enumerate(tracks):
+        assert (collection.track(i) == track).all()
+
+
+def test_smooth_segments():
+    x = np.random.RandomState(0).rand(300) * 40
+    offsets = [0, 100, 105, 300]
+
+    y = smooth_segments(x, offsets, window_lens=[11, 11, 50])
+
+    assert (y[0:100] == smooth(x[0:100])).all()
+    # too short to smooth
+    assert (y[100:105] == x[100:105]).all()
+    assert np.allclose(y[105:300], smooth(x[105:300], window_len=50))
+
+
+def test_calculate_vels(tracks):
+    vels = Tracks(tracks).calculate_vels()
+
+    assert vels.ntracks == len(tracks)
+
+    for i, track in enumerate(tracks):
+        expected = track.calculate_vels()
+        actual = vels.track(i)
+
+        assert len(actual) == len(expected)
+
+        for name in expected.dtype.names:
+            if name == 'time':
+                assert (actual.time == expected.time).all()
+            else:
+                assert np.allclose(actual[name], expected[name])
@@ -0,0 +1,65 @@
+import struct
+
+import numpy as np
+import pytest
+
+from cyclerouter.wkb import encode_linestring, decode_linestring
+
+
+def test_encode_linestring():
+    coords = np.array([[144.96, -37.81, 30., 0.],
+                       [144.97, -37.80, 32., 4.5]])
+
+    wkb = encode_linestring(coords)
+
+    assert wkb.encode('hex') == (
+        '01'        # little endian
+        '020000c0'  # LineString ZM
+        '02000000'  # 2 points
+        ) + coords.astype('<f8').tostring().encode('hex')
+
+
+def test_encode_linestring_srid():
+    coords = np.array([[144.96, -37.81], [144.97, -37.80]])
+
+    wkb = encode_linestring(coords, srid=4326)
+
+    order, wkbtype, srid, npoints = struct.unpack('<BIII', wkb[:13])
+
+    assert order == 1
+    assert wkbtype == 0x20000002
+    assert srid == 4326
+    assert npoints == 2
+    assert len(wkb) == 13 + 2 * 2 * 8
+
+
+def test_encode_linestring_bad_dims():
+    with pytest.raises(ValueError):
+        encode_linestring(np.zeros((3, 5)))
+
+
+@pytest.mark.parametrize('srid', [None, 4326])
+@pytest.mark.parametrize('ndims', [2, 3, 4])
+def test_decode_linestring(srid, ndims):
+    coords = np.random.RandomState(0).rand(10, ndims)
+
+    wkb = encode_linestring(coords, srid=srid)
+    decoded = decode_linestring(wkb)
+
+    assert decoded.shape == coords.shape
+    assert (decoded == coords).all()
+
+
+def test_decode_linestring_iso_big_endian():
+    coords = np.array([[144.96, -37.81, 30., 0.],
+                       [144.97, -37.80, 32., 4.5]])
+
+    # as returned by ST_AsBinary(points, 'XDR')
+    wkb = struct.pack('>BII', 0, 3002, 2) + coords.astype('>f8').tostring()
+
+    assert (decode_linestring(wkb) == coords).all()
+
+
+def test_decode_linestring_not_linestring():
+    with pytest.raises(ValueError):
+        decode_linestring(struct.pack('<BIdd', 1, 1, 0., 0.))